@@ -0,0 +1,218 @@
+"""
+Versions of the output middlewares for new-style (``MIDDLEWARE``) stacks that
+work both in synchronous and asynchronous mode.
+
+Under ASGI, Django runs synchronous middlewares in a thread; these ones are
+async-capable, so the whitespace filtering and header setting run directly in
+the event loop, while Tidy is run in an executor (a thread on default or a
+process pool with ``TIDY_PROCESSES``). Streaming responses with asynchronous
+iterators are filtered with async generators.
+
+The settings are the same as for the corresponding middlewares in
+``utils.middleware``. Needs Python 3 and Django 4.1 or newer.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from utils import instrumentation, middleware
+
+
+class DualMiddleware:
+    """
+    Calls ``process_response()`` in synchronous mode and awaits
+    ``aprocess_response()`` in asynchronous mode, without switching threads.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        return await self.aprocess_response(request, response)
+
+    def process_response(self, request, response):
+        raise NotImplementedError
+
+    async def aprocess_response(self, request, response):
+        return self.process_response(request, response)
+
+
+async def process_async_stream(whitespace_filter, chunks):
+    """
+    As ``WhitespaceFilter.process_stream()``, for an asynchronous iterable.
+    """
+    stream = middleware.WhitespaceStream(whitespace_filter)
+    async for chunk in chunks:
+        chunk = stream.feed(chunk)
+        if chunk:
+            yield chunk
+    chunk = stream.close()
+    if chunk:
+        yield chunk
+
+
+def filter_response(response, whitespace_filter):
+    # Streaming content may be iterated synchronously or asynchronously.
+    if getattr(response, 'is_async', False):
+        response.streaming_content = process_async_stream(
+            whitespace_filter, response.streaming_content)
+    else:
+        middleware.filter_response(response, whitespace_filter)
+
+
+class WhitespaceMiddleware(DualMiddleware):
+    whitespace_filter = None
+
+    def process_response(self, request, response):
+        if 'text/html' in response.get('Content-Type', ''):
+            filter_response(response, self.whitespace_filter)
+        return response
+
+
+class NoStartingTrailingBlankLinesMiddleware(WhitespaceMiddleware):
+    """
+    See ``utils.middleware.NoStartingTrailingBlankLinesMiddleware``.
+    """
+    whitespace_filter = middleware.WhitespaceFilter(whitespace_lines=False)
+
+
+class NoWhitespaceLinesMiddleware(WhitespaceMiddleware):
+    """
+    See ``utils.middleware.NoWhitespaceLinesMiddleware``.
+    """
+    whitespace_filter = middleware.WhitespaceFilter(blank_lines=False)
+
+
+class TidyMiddleware(DualMiddleware):
+    """
+    See ``utils.middleware.TidyMiddleware``, in asynchronous mode misses are
+    tidied in an executor, which is awaited for at most ``TIDY_TIMEOUT``
+    seconds if ``TIDY_PROCESSES`` is set.
+    """
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.tidier = middleware.TidyMiddleware()
+        self.executor = None
+
+    def process_response(self, request, response):
+        return self.tidier.process_response(request, response)
+
+    async def aprocess_response(self, request, response):
+        if (not getattr(response, 'streaming', False) and
+                'text/html' in response.get('Content-Type', '')):
+            started = instrumentation.start()
+            content = response.content
+            response.content = await self.atidy(content)
+            if started is not None:
+                instrumentation.record('tidy', started, len(content),
+                                       len(response.content), 0, response)
+        return response
+
+    async def atidy(self, content):
+        """
+        As ``utils.middleware.TidyMiddleware.tidy()``, but awaits the work.
+        """
+        tidier = self.tidier
+        started = time.time()
+        key = hashlib.sha1(content).digest()
+        tidied = tidier.cache.get(key)
+        if tidied is not None:
+            kind = 'hits'
+        else:
+            kind = 'misses'
+            future = asyncio.get_running_loop().run_in_executor(
+                self.get_executor(), middleware.tidy_content, content)
+            future.add_done_callback(functools.partial(self.cache_result, key))
+            if tidier.processes:
+                # Unlike wait_for(), wait() leaves the work running.
+                done, pending = await asyncio.wait([future],
+                                                   timeout=tidier.timeout)
+                if pending:
+                    kind, tidied = 'timeouts', content
+                else:
+                    tidied = future.result()
+            else:
+                tidied = await future
+        tidier.count(kind, time.time() - started)
+        return tidied
+
+    def cache_result(self, key, future):
+        if not future.cancelled() and future.exception() is None:
+            self.tidier.cache.put(key, future.result())
+
+    def get_executor(self):
+        # The loop's default (thread) executor, unless processes are set.
+        if self.tidier.processes and self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.tidier.processes)
+        return self.executor
+
+
+class HTMLPostProcessMiddleware(TidyMiddleware):
+    """
+    See ``utils.middleware.HTMLPostProcessMiddleware``.
+    """
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.post_processor = middleware.HTMLPostProcessMiddleware()
+        self.tidier = self.post_processor.tidy
+
+    def process_response(self, request, response):
+        if getattr(response, 'streaming', False):
+            return self.filter_stream(response)
+        return self.post_processor.process_response(request, response)
+
+    async def aprocess_response(self, request, response):
+        if getattr(response, 'streaming', False):
+            return self.filter_stream(response)
+        if 'text/html' not in response.get('Content-Type', ''):
+            return response
+        whitespace_filter = self.post_processor.whitespace_filter
+        started = instrumentation.start()
+        content = original = response.content
+        passes = 0
+        if whitespace_filter is not None:
+            content = whitespace_filter.process(content)
+            passes = whitespace_filter.passes
+        if self.tidier is not None:
+            content = await self.atidy(content)
+        response.content = content
+        if started is not None:
+            instrumentation.record('html-post-process', started,
+                                   len(original), len(content), passes,
+                                   response)
+        return response
+
+    def filter_stream(self, response):
+        whitespace_filter = self.post_processor.whitespace_filter
+        if (whitespace_filter is not None and
+                'text/html' in response.get('Content-Type', '')):
+            filter_response(response, whitespace_filter)
+        return response
+
+
+class CSPMiddleware(DualMiddleware):
+    """
+    See ``utils.middleware.CSPMiddleware``.
+    """
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.csp = middleware.CSPMiddleware()
+
+    def process_response(self, request, response):
+        return self.csp.process_response(request, response)
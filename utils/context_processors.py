@@ -1,4 +1,22 @@
-from django.contrib.sites.models import get_current_site
+from django.contrib.sites.models import Site, get_current_site
+from django.db.models.signals import post_delete, post_save
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.functional import lazy
+
+
+# Results of site_context() by host, until a site is saved or deleted (or
+# there are too many hosts).
+MAX_HOSTS = 1000
+site_contexts = {}
+
+
+def clear_site_contexts(**kwargs):
+    site_contexts.clear()
+
+
+post_save.connect(clear_site_contexts, sender=Site)
+post_delete.connect(clear_site_contexts, sender=Site)
 
 
 def site_context(site):
@@ -8,8 +26,37 @@ def site_context(site):
     }
 
 
-def site(request):
-    current_site = get_current_site(request)
-    context = site_context(current_site)
-    context['BASE_URL'] = request.build_absolute_uri('/').rstrip('/')
+def request_site_context(request):
+    """
+    Site context of the request, with its BASE_URL, computed once for the
+    request.
+    """
+    context = getattr(request, '_site_context', None)
+    if context is None:
+        host = request.get_host()
+        context = site_contexts.get(host)
+        if context is None:
+            if len(site_contexts) >= MAX_HOSTS:
+                site_contexts.clear()
+            context = site_contexts[host] = site_context(
+                get_current_site(request))
+        context = dict(context)
+        context['BASE_URL'] = force_text(
+            request.build_absolute_uri('/').rstrip('/'))
+        request._site_context = context
     return context
+
+
+def site_value(request, name):
+    return request_site_context(request)[name]
+
+
+lazy_site_value = lazy(site_value, six.text_type)
+
+
+def site(request):
+    """
+    Values are computed when first used in a template (and behave as text).
+    """
+    return dict((name, lazy_site_value(request, name))
+                for name in ('SITE_DOMAIN', 'SITE_NAME', 'BASE_URL'))
@@ -1,6 +1,16 @@
 from urlparse import urljoin
 
 from django import forms
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+
+# Base URLs of sites by their ids, until a site is saved or deleted.
+site_base_urls = {}
+
+
+def clear_site_base_urls(**kwargs):
+    site_base_urls.clear()
 
 
 class URLField(forms.URLField):
@@ -8,13 +18,52 @@ class URLField(forms.URLField):
         self.base_url = kwargs.pop('base_url', None)
         super(URLField, self).__init__(*args, **kwargs)
 
-    def to_python(self, value):
-        if not value:
-            return value
-        base_url = self.base_url
+    def get_base_url(self):
+        """
+        The base URL given, or the one of the current site.
+        """
+        if self.base_url is not None:
+            return self.base_url
+        site_id = getattr(settings, 'SITE_ID', None)
+        base_url = site_base_urls.get(site_id)
         if base_url is None:
             from django.contrib.sites.models import Site
+            for signal in (post_save, post_delete):
+                signal.connect(clear_site_base_urls, sender=Site,
+                               dispatch_uid='utils.forms.site_base_urls')
             domain = Site.objects.get_current().domain
-            base_url = '//{}/'.format(domain)
-        value = urljoin(base_url, value)
+            base_url = site_base_urls[site_id] = '//{}/'.format(domain)
+        return base_url
+
+    def to_python(self, value):
+        if not value:
+            return value
+        value = urljoin(self.get_base_url(), value)
         return super(URLField, self).to_python(value)
+
+    def to_python_many(self, values):
+        """
+        As ``to_python()`` for each of the values, resolving the base URL
+        once.
+        """
+        base_url = None
+        converted = []
+        for value in values:
+            if value:
+                if base_url is None:
+                    base_url = self.get_base_url()
+                value = super(URLField, self).to_python(
+                    urljoin(base_url, value))
+            converted.append(value)
+        return converted
+
+    def clean_many(self, values):
+        """
+        As ``clean()`` for each of the values, raises the first validation
+        error.
+        """
+        values = self.to_python_many(values)
+        for value in values:
+            self.validate(value)
+            self.run_validators(value)
+        return values
@@ -0,0 +1,188 @@
+"""
+Optional measurements of output post-processing (the middlewares and the
+``blankless`` and ``indent`` template tags): time taken, input and output
+sizes and the number of regex passes.
+
+Nothing is measured unless ``DEBUG`` is on or ``OUTPUT_STATS_COLLECTOR`` is
+set. In debug mode, measurements are added to responses as ``Server-Timing``
+headers (those of template tags go to the response of the request being
+handled, up to the latest ``MAX_PENDING`` ones). ``OUTPUT_STATS_COLLECTOR`` is a dotted path to a
+collector class, for example ``'utils.instrumentation.StatsCollector'``; its
+instance, returned by ``get_collector()``, receives all measurements through
+its ``record()`` method. Streaming responses are not measured.
+"""
+from importlib import import_module
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python 2.
+    ContextVar = None
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    """
+    Counts of values in geometric buckets (each about 19% wider than the
+    previous one), for estimating percentiles in constant memory.
+    """
+    def __init__(self, smallest=1e-6, factor=2 ** 0.25):
+        self.smallest = smallest
+        self.factor = factor
+        self.counts = {}  # Bucket number --> count of values.
+        self.count = 0
+
+    def add(self, value):
+        if value <= self.smallest:
+            bucket = 0
+        else:
+            bucket = int(math.ceil(math.log(value / self.smallest,
+                                            self.factor)))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket with the given percentile, None if there
+        are no values.
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                break
+        return self.smallest * self.factor ** bucket
+
+
+class StatsCollector(object):
+    """
+    Aggregates measurements by name, keeping histograms of times.
+    """
+    percentiles = (50, 90, 99)
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, input_size, output_size, passes):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                entry = self.entries[name] = {
+                    'count': 0, 'time': 0.0, 'times': Histogram(),
+                    'input': 0, 'output': 0, 'passes': 0}
+            entry['count'] += 1
+            entry['time'] += seconds
+            entry['times'].add(seconds)
+            entry['input'] += input_size
+            entry['output'] += output_size
+            entry['passes'] += passes
+
+    def stats(self):
+        """
+        Summaries by name: count, total time, time percentiles (as "p50" and
+        so on), total input and output sizes, bytes saved and regex passes.
+        """
+        with self.lock:
+            stats = {}
+            for name, entry in self.entries.items():
+                summary = dict((key, value) for key, value in entry.items()
+                               if key != 'times')
+                summary['saved'] = entry['input'] - entry['output']
+                for percent in self.percentiles:
+                    summary['p{}'.format(percent)] = \
+                        entry['times'].percentile(percent)
+                stats[name] = summary
+            return stats
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+
+
+_collector = {}
+
+
+def get_collector():
+    """
+    The collector chosen with ``OUTPUT_STATS_COLLECTOR``, None if not set.
+    """
+    if 'collector' not in _collector:
+        path = getattr(settings, 'OUTPUT_STATS_COLLECTOR', None)
+        collector = None
+        if path:
+            module, _, name = path.rpartition('.')
+            collector = getattr(import_module(module), name)()
+        _collector['collector'] = collector
+    return _collector['collector']
+
+
+# Server-Timing entries of template tags, waiting for the response. Kept in
+# a context variable, so that requests handled concurrently by one thread
+# (under ASGI) are kept apart, or in a thread-local on Python 2. Templates may
+# also be rendered outside of requests, so only the latest entries are kept.
+MAX_PENDING = 50
+
+if ContextVar is not None:
+    _pending = ContextVar('pending', default=())
+    get_pending, set_pending = _pending.get, _pending.set
+else:
+    _local = threading.local()
+
+    def get_pending():
+        return getattr(_local, 'pending', ())
+
+    def set_pending(pending):
+        _local.pending = pending
+
+
+def reset_pending(**kwargs):
+    set_pending(())
+
+
+request_started.connect(reset_pending)
+request_finished.connect(reset_pending)
+
+
+def start():
+    """
+    Start of a measurement (to be passed to ``record()``), None if nothing
+    is measured.
+    """
+    if settings.DEBUG or get_collector() is not None:
+        return timer()
+    return None
+
+
+def record(name, started, input_size, output_size, passes, response=None):
+    """
+    Finishes a measurement started with ``start()``. In debug mode, it is
+    added to the ``Server-Timing`` header of the response, or of the next
+    response if none is given.
+    """
+    seconds = timer() - started
+    collector = get_collector()
+    if collector is not None:
+        collector.record(name, seconds, input_size, output_size, passes)
+    if settings.DEBUG:
+        entry = '{};dur={:.3f};desc="{} B -> {} B, {} passes"'.format(
+            name, seconds * 1000, input_size, output_size, passes)
+        # Tuples, as lists would be shared by copies of the context.
+        pending = get_pending()[-MAX_PENDING + 1:] + (entry,)
+        if response is None:
+            set_pending(pending)
+        else:
+            if response.has_header('Server-Timing'):
+                pending = (response['Server-Timing'],) + pending
+            response['Server-Timing'] = ', '.join(pending)
+            set_pending(())
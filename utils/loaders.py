@@ -0,0 +1,92 @@
+import re
+
+from django.template.base import TemplateDoesNotExist, TextNode
+from django.template.loader import (BaseLoader, find_template_loader,
+                                    get_template_from_string, make_origin)
+from django.template.loader_tags import ExtendsNode
+
+
+# Whitespace only lines fully contained in a text node (starting after a new
+# line and followed by one).
+TEXT_WHITESPACE_LINES = re.compile(r'\n[^\S\n]+(?=\n)')
+
+LEADING_LINES = re.compile(r'(?:[^\S\n]*\n)*')
+TRAILING_LINES = re.compile(r'\n(?:[^\S\n]*\n)*\Z')
+
+
+class WhitespaceLoader(BaseLoader):
+    """
+    Wraps other template loaders, removing whitespace from the static text of
+    templates once, when they're compiled.
+
+    Whitespace only lines are removed from all text nodes (as done by
+    ``NoWhitespaceLinesMiddleware`` for the whole output, but only for lines
+    that don't include any tags or variables). Unless ``blank_lines`` is false,
+    blank and whitespace lines at the start and at the end of templates that
+    don't extend others are also reduced to a single new line (this includes
+    templates that are included in others, which stay separated).
+
+    For templates loaded this way, the whitespace middlewares have little
+    left to do. Use it as the cached loader, for example::
+
+        TEMPLATE_LOADERS = (
+            ('django.template.loaders.cached.Loader', (
+                ('utils.loaders.WhitespaceLoader', (
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                )),
+            )),
+        )
+    """
+    is_usable = True
+
+    def __init__(self, loaders, blank_lines=True):
+        self._loaders = loaders
+        self._cached_loaders = []
+        self.blank_lines = blank_lines
+
+    @property
+    def loaders(self):
+        # Resolved on demand, as by the cached loader.
+        if not self._cached_loaders:
+            self._cached_loaders = [find_template_loader(loader)
+                                    for loader in self._loaders]
+        return self._cached_loaders
+
+    def load_template(self, template_name, template_dirs=None):
+        for loader in self.loaders:
+            try:
+                template, display_name = loader(template_name, template_dirs)
+            except TemplateDoesNotExist:
+                continue
+            if not hasattr(template, 'render'):
+                origin = make_origin(display_name, loader, template_name,
+                                     template_dirs)
+                try:
+                    template = get_template_from_string(template, origin,
+                                                        template_name)
+                except TemplateDoesNotExist:
+                    # As the cached loader, identifies the missing template.
+                    return template, origin
+            self.strip(template)
+            return template, None
+        raise TemplateDoesNotExist(template_name)
+
+    def strip(self, template):
+        """
+        Removes whitespace from text nodes of a compiled template (stripping
+        an already stripped template changes nothing).
+        """
+        nodelist = template.nodelist
+        for node in nodelist.get_nodes_by_type(TextNode):
+            node.s = TEXT_WHITESPACE_LINES.sub('', node.s)
+        if (self.blank_lines and nodelist and
+                not isinstance(nodelist[0], ExtendsNode)):
+            if isinstance(nodelist[0], TextNode):
+                first = nodelist[0]
+                end = LEADING_LINES.match(first.s).end()
+                if end:
+                    first.s = '\n' + first.s[end:]
+            if isinstance(nodelist[-1], TextNode):
+                last = nodelist[-1]
+                last.s = TRAILING_LINES.sub('\n', last.s)
@@ -1,6 +1,28 @@
+import collections
+import functools
+import hashlib
+import multiprocessing
 import re
+import threading
+import time
+import zlib
 
 from django.conf import settings
+from django.utils.cache import cc_delim_re, patch_vary_headers
+
+from utils import instrumentation
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from django.utils.decorators import available_attrs
+except ImportError:
+    # Removed in Django 3.0, all attributes may be assigned there.
+    def available_attrs(fn):
+        return functools.WRAPPER_ASSIGNMENTS
 
 
 STARTING_BLANK_LINES = re.compile(r'^\n+')
@@ -10,39 +32,552 @@ WHITESPACE_LINES = re.compile(r'^[^\S\n]+\n', re.MULTILINE)
 
 TIDY_OPTIONS = {'indent': 'auto', 'wrap': 0}
 
+# Used by WhitespaceFilter: leading blank or whitespace lines are matched at
+# the start, the rest of whitespace lines with a pattern starting with a
+# literal (which is found much faster than a line start).
+LEADING_BLANK_LINES = re.compile(br'\n*')
+LEADING_WHITESPACE_LINES = re.compile(br'(?:[^\S\n]+\n)*')
+LEADING_BLANK_OR_WHITESPACE_LINES = re.compile(br'(?:[^\S\n]*\n)*')
+INNER_WHITESPACE_LINES = re.compile(br'\n[^\S\n]+(?=\n)')
+
+POST_PROCESS_TRANSFORMS = ('blank_lines', 'whitespace_lines', 'tidy')
+
+
+class WhitespaceFilter(object):
+    """
+    Removes blank lines at the beginning and at the end and / or whitespace
+    only lines from HTML, given as a whole or as a stream of chunks. With
+    both enabled, the output is the same as with whitespace lines removed
+    first.
+    """
+    def __init__(self, blank_lines=True, whitespace_lines=True):
+        self.blank_lines = blank_lines
+        self.whitespace_lines = whitespace_lines
+        self.passes = 2 if whitespace_lines else 1  # Regex passes made.
+        if blank_lines and whitespace_lines:
+            self.leading = LEADING_BLANK_OR_WHITESPACE_LINES
+        elif blank_lines:
+            self.leading = LEADING_BLANK_LINES
+        else:
+            self.leading = LEADING_WHITESPACE_LINES
+
+    def process(self, content):
+        """
+        Filters the whole content (bytes), scanning it just once.
+        """
+        start = self.leading.match(content).end()
+        end = len(content)
+        if self.blank_lines and content.endswith(b'\n'):
+            if self.whitespace_lines:
+                # Up to the end of the last line with anything but spaces.
+                end = content.find(b'\n', len(content.rstrip()))
+            else:
+                end = len(content.rstrip(b'\n'))
+        if start or end < len(content):
+            content = content[start:max(start, end)]
+        if self.whitespace_lines:
+            content = INNER_WHITESPACE_LINES.sub(b'', content)
+        return content
+
+    def process_stream(self, chunks):
+        """
+        Filters an iterable of chunks (bytes), yielding filtered chunks.
+
+        Whitespace after the last line with any content is held back until
+        the next chunk shows what to do with it, so memory use does not
+        depend on the content length and chunks are passed on as they come.
+        """
+        stream = WhitespaceStream(self)
+        for chunk in chunks:
+            chunk = stream.feed(chunk)
+            if chunk:
+                yield chunk
+        chunk = stream.close()
+        if chunk:
+            yield chunk
+
+
+class WhitespaceStream(object):
+    """
+    State of a stream filtered by ``WhitespaceFilter.process_stream()``,
+    chunks are fed one at a time (so they may also come asynchronously).
+    """
+    def __init__(self, whitespace_filter):
+        self.filter = whitespace_filter
+        self.held = b''  # Whitespace that may still be removed.
+        self.started = False  # Has any content been passed on?
+        self.line_open = False  # Does the content end within a line?
+
+    def feed(self, chunk):
+        """
+        Filtered content that can be passed on after the chunk.
+        """
+        data = self.held + chunk
+        cut = self._safe_length(data)
+        if not cut:
+            self.held = data
+            return b''
+        segment, self.held = data[:cut], data[cut:]
+        self.line_open = not self.held
+        if not self.started:
+            segment = segment[self.filter.leading.match(segment).end():]
+            self.started = True
+        if self.filter.whitespace_lines:
+            segment = INNER_WHITESPACE_LINES.sub(b'', segment)
+        return segment
+
+    def close(self):
+        """
+        Filtered rest of the content, once all chunks have been fed.
+        """
+        held, whitespace_filter = self.held, self.filter
+        self.held = b''
+        if not self.started:
+            return whitespace_filter.process(held)
+        elif whitespace_filter.blank_lines and (
+                held.endswith(b'\n') or not whitespace_filter.whitespace_lines):
+            return b''
+        elif whitespace_filter.whitespace_lines:
+            return INNER_WHITESPACE_LINES.sub(b'', held)
+        return held
+
+    def _safe_length(self, data):
+        # Length of the prefix that following data can't change: up to the
+        # end of the last line with any content (just the end of the last
+        # non-newline if only blank lines are removed). If the data continues
+        # a line that has been passed on, that line has content.
+        if not self.filter.whitespace_lines:
+            return len(data.rstrip(b'\n'))
+        end = len(data.rstrip())
+        if not end and not self.line_open:
+            return 0
+        cut = data.find(b'\n', end)
+        return len(data) if cut == -1 else cut
+
+
+def filter_response(response, whitespace_filter):
+    """
+    Applies the filter to the content of a (possibly streaming) response.
+    """
+    if getattr(response, 'streaming', False):
+        response.streaming_content = whitespace_filter.process_stream(
+            response.streaming_content)
+        # The length of the filtered content isn't known in advance.
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+    else:
+        response.content = whitespace_filter.process(response.content)
+
 
 class NoStartingTrailingBlankLinesMiddleware:
     """
     Removes blank lines at the begginging and at the end of output
-    (whole response).
+    (whole response). Streaming responses are filtered as they're sent.
     """
+    whitespace_filter = WhitespaceFilter(whitespace_lines=False)
+
     def process_response(self, request, response):
         if 'text/html' in response['Content-Type']:
-            response.content = STARTING_BLANK_LINES.sub('', response.content)
-            response.content = TRAILING_BLANK_LINES.sub('', response.content)
+            if getattr(response, 'streaming', False):
+                filter_response(response, self.whitespace_filter)
+            else:
+                started = instrumentation.start()
+                content = response.content
+                response.content = STARTING_BLANK_LINES.sub('', content)
+                response.content = TRAILING_BLANK_LINES.sub('', response.content)
+                if started is not None:
+                    instrumentation.record(
+                        'blank-lines', started, len(content),
+                        len(response.content), 2, response)
         return response
 
 
 class NoWhitespaceLinesMiddleware:
     """
-    Removes all whitespace only (but non-empty) lines in output.
+    Removes all whitespace only (but non-empty) lines in output. Streaming
+    responses are filtered as they're sent.
     """
+    whitespace_filter = WhitespaceFilter(blank_lines=False)
+
     def process_response(self, request, response):
         if 'text/html' in response['Content-Type']:
-            response.content = WHITESPACE_LINES.sub('', response.content)
+            if getattr(response, 'streaming', False):
+                filter_response(response, self.whitespace_filter)
+            else:
+                started = instrumentation.start()
+                content = response.content
+                response.content = WHITESPACE_LINES.sub('', content)
+                if started is not None:
+                    instrumentation.record(
+                        'whitespace-lines', started, len(content),
+                        len(response.content), 1, response)
         return response
 
 
+def tidy_content(content):
+    """
+    Runs content through Tidy (a function, so it may be run in a pool).
+    """
+    import tidy
+    return str(tidy.parseString(content))
+
+
+class ContentCache(object):
+    """
+    Processed contents (such as tidied or compressed ones), bounded by their
+    total size; least recently used entries are evicted first.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            content = self.entries.pop(key, None)
+            if content is not None:
+                self.entries[key] = content
+            return content
+
+    def put(self, key, content):
+        if len(content) > self.max_size:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = content
+            self.size += len(content)
+            while self.size > self.max_size:
+                key, previous = self.entries.popitem(last=False)
+                self.size -= len(previous)
+
+
+# Counters of all Tidy middlewares, see tidy_stats().
+_tidy_stats = {'hits': 0, 'misses': 0, 'timeouts': 0,
+               'hit_time': 0.0, 'miss_time': 0.0}
+_tidy_stats_lock = threading.Lock()
+
+
+def tidy_stats():
+    """
+    Counts of Tidy cache hits, misses and timeouts (which are not counted as
+    misses), and the time spent on hits and on the others, summed over all
+    instances of ``TidyMiddleware`` in the process.
+    """
+    with _tidy_stats_lock:
+        return dict(_tidy_stats)
+
+
 class TidyMiddleware:
     """
     Runs output through Tidy.
+
+    Outputs are cached by a hash of the content, up to ``TIDY_CACHE_SIZE``
+    bytes (8 MB on default, 0 disables caching). If ``TIDY_PROCESSES`` is
+    set, cache misses are tidied in a pool of that many processes, and a
+    response that takes more than ``TIDY_TIMEOUT`` seconds (1 on default) is
+    sent untidied; its output is still cached once ready. Streaming
+    responses are not tidied. Cache statistics are given by ``tidy_stats()``.
     """
+    def __init__(self):
+        self.cache = ContentCache(getattr(settings, 'TIDY_CACHE_SIZE', 8 << 20))
+        self.processes = getattr(settings, 'TIDY_PROCESSES', None)
+        self.timeout = getattr(settings, 'TIDY_TIMEOUT', 1.0)
+        self.pool = None
+        self.lock = threading.Lock()
+
     def process_response(self, request, response):
-        if 'text/html' in response['Content-Type']:
-            import tidy
-            response.content = str(tidy.parseString(response.content))
+        if (not getattr(response, 'streaming', False) and
+                'text/html' in response['Content-Type']):
+            started = instrumentation.start()
+            content = response.content
+            response.content = self.tidy(content)
+            if started is not None:
+                instrumentation.record('tidy', started, len(content),
+                                       len(response.content), 0, response)
         return response
 
+    def tidy(self, content):
+        """
+        Tidied content, from the cache if possible.
+        """
+        started = time.time()
+        key = hashlib.sha1(content).digest()
+        tidied = self.cache.get(key)
+        if tidied is not None:
+            kind = 'hits'
+        elif self.processes:
+            kind = 'misses'
+            result = self.get_pool().apply_async(
+                tidy_content, (content,),
+                callback=functools.partial(self.cache.put, key))
+            try:
+                tidied = result.get(self.timeout)
+            except multiprocessing.TimeoutError:
+                kind, tidied = 'timeouts', content
+        else:
+            kind = 'misses'
+            tidied = tidy_content(content)
+            self.cache.put(key, tidied)
+        self.count(kind, time.time() - started)
+        return tidied
+
+    @staticmethod
+    def count(kind, elapsed):
+        """
+        Adds a cache hit, miss or timeout to ``tidy_stats()``.
+        """
+        with _tidy_stats_lock:
+            _tidy_stats[kind] += 1
+            _tidy_stats['hit_time' if kind == 'hits' else 'miss_time'] += elapsed
+
+    def get_pool(self):
+        # Started on first use, in the process serving requests.
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes)
+            return self.pool
+
+
+class HTMLPostProcessMiddleware:
+    """
+    Applies the transforms of the middlewares above in a single pass.
+
+    Stacking the middlewares copies the content for each regex pass, here
+    leading and trailing lines are cut off by bounds found at the ends, and
+    whitespace lines in between are removed in one scan (Tidy, if enabled,
+    still runs on the result). Choose the transforms with the
+    ``HTML_POST_PROCESSING`` setting, a sequence of: ``'blank_lines'`` (as
+    ``NoStartingTrailingBlankLinesMiddleware``), ``'whitespace_lines'`` (as
+    ``NoWhitespaceLinesMiddleware``) and ``'tidy'`` (as ``TidyMiddleware``,
+    with its cache and settings).
+    Both whitespace transforms are enabled on default, see
+    ``WhitespaceFilter``. Streaming responses are filtered chunk by chunk,
+    but not tidied.
+    """
+    def __init__(self):
+        transforms = getattr(settings, 'HTML_POST_PROCESSING',
+                             ('blank_lines', 'whitespace_lines'))
+        unknown = set(transforms) - set(POST_PROCESS_TRANSFORMS)
+        if unknown:
+            raise ValueError("Unknown HTML post-processing transforms: "
+                             "{}.".format(', '.join(sorted(unknown))))
+        blank_lines = 'blank_lines' in transforms
+        whitespace_lines = 'whitespace_lines' in transforms
+        if blank_lines or whitespace_lines:
+            self.whitespace_filter = WhitespaceFilter(blank_lines,
+                                                      whitespace_lines)
+        else:
+            self.whitespace_filter = None
+        self.tidy = TidyMiddleware() if 'tidy' in transforms else None
+
+    def process_response(self, request, response):
+        if 'text/html' not in response['Content-Type']:
+            return response
+        if getattr(response, 'streaming', False):
+            if self.whitespace_filter is not None:
+                filter_response(response, self.whitespace_filter)
+            return response
+        started = instrumentation.start()
+        content = original = response.content
+        passes = 0
+        if self.whitespace_filter is not None:
+            content = self.whitespace_filter.process(content)
+            passes = self.whitespace_filter.passes
+        if self.tidy is not None:
+            content = self.tidy.tidy(content)
+        response.content = content
+        if started is not None:
+            instrumentation.record('html-post-process', started,
+                                   len(original), len(content), passes,
+                                   response)
+        return response
+
+
+# Content encodings, in the order of preference, see MinifyCompressMiddleware.
+ENCODINGS = ('br', 'gzip', 'deflate') if brotli is not None else (
+    'gzip', 'deflate')
+
+ACCEPTS_ENCODING = dict((encoding, re.compile(r'\b{}\b'.format(encoding)))
+                        for encoding in ENCODINGS)
+
+
+def compressor(encoding, level):
+    """
+    Object with the compress() and flush() methods of zlib compressors.
+    """
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return zlib.compressobj(level)
+    return BrotliCompressor(level)
+
+
+class BrotliCompressor(object):
+    """
+    Brotli compressor with the interface of zlib ones.
+    """
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compresses an iterable of chunks, yielding compressed chunks.
+    """
+    compress = compressor(encoding, level)
+    for chunk in chunks:
+        chunk = compress.compress(chunk)
+        if chunk:
+            yield chunk
+    yield compress.flush()
+
+
+def vary_values(request, response):
+    """
+    Values of the request headers listed in ``Vary`` of the response, other
+    than ``Accept-Encoding``, None if the response varies on anything else
+    (``*``).
+    """
+    values = []
+    for header in cc_delim_re.split(response.get('Vary', '')):
+        header = header.upper().replace('-', '_')
+        if header == '*':
+            return None
+        if header and header != 'ACCEPT_ENCODING':
+            values.append((header, request.META.get('HTTP_' + header)))
+    return tuple(sorted(values))
+
+
+class MinifyCompressMiddleware:
+    """
+    Removes blank and whitespace lines from HTML (as
+    ``HTMLPostProcessMiddleware`` on default) and compresses it in one
+    stage, passing filtered pieces straight to an incremental compressor.
+
+    Brotli is used if installed and accepted by the client, else gzip or
+    deflate. Bodies of responses with an ``ETag`` are cached, keyed by the
+    tag, the request path with the query string (tags may be shared by
+    different pages), the encoding and the request headers the response
+    varies on (such as ``Cookie``), so pages that haven't changed are
+    neither filtered nor compressed again; the cache keeps up to
+    ``OUTPUT_COMPRESSION_CACHE_SIZE`` bytes (16 MB on default).
+    ``OUTPUT_COMPRESSION_LEVEL`` sets the level (6 on default). Use it
+    instead of ``GZipMiddleware`` (or the whitespace middlewares) for HTML
+    responses, as the last middleware to process them.
+    """
+    whitespace_filter = WhitespaceFilter()
+
+    def __init__(self):
+        self.cache = ContentCache(getattr(
+            settings, 'OUTPUT_COMPRESSION_CACHE_SIZE', 16 << 20))
+        self.level = getattr(settings, 'OUTPUT_COMPRESSION_LEVEL', 6)
+
+    def process_response(self, request, response):
+        if ('text/html' not in response.get('Content-Type', '') or
+                response.has_header('Content-Encoding')):
+            return response
+        streaming = getattr(response, 'streaming', False)
+        if not streaming and len(response.content) < 200:
+            # Not worth compressing (this includes empty bodies).
+            filter_response(response, self.whitespace_filter)
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        accepted = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        for encoding in ENCODINGS:
+            if ACCEPTS_ENCODING[encoding].search(accepted):
+                break
+        else:
+            filter_response(response, self.whitespace_filter)
+            return response
+        if streaming:
+            response.streaming_content = compress_stream(
+                self.whitespace_filter.process_stream(
+                    response.streaming_content),
+                encoding, self.level)
+            if response.has_header('Content-Length'):
+                del response['Content-Length']
+        else:
+            started = instrumentation.start()
+            content = response.content
+            etag = response.get('ETag')
+            varying = vary_values(request, response)
+            cached = etag and varying is not None
+            key = (etag, request.get_full_path(), encoding, varying)
+            compressed = self.cache.get(key) if cached else None
+            if compressed is None:
+                compressed = b''.join(compress_stream(
+                    self.whitespace_filter.process_stream([content]),
+                    encoding, self.level))
+                if cached:
+                    self.cache.put(key, compressed)
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+            if started is not None:
+                instrumentation.record(
+                    'minify-compress', started, len(content),
+                    len(compressed), self.whitespace_filter.passes, response)
+        if response.has_header('ETag'):
+            response['ETag'] = re.sub('"$', ';{}"'.format(encoding),
+                                      response['ETag'])
+        response['Content-Encoding'] = encoding
+        return response
+
+
+# Content security headers with the settings that control them and their
+# defaults, see CSPMiddleware.
+CSP_HEADERS = (
+    # X-Frame-Options defaults to "SAMEORIGIN" (explicitely setting
+    # to None disables).
+    ('X-Frame-Options', 'X_FRAME_OPTIONS', 'SAMEORIGIN'),
+    # TODO: Should X-Content-Security-Policy now default to
+    #       "allow: 'self'" or "default-src \'self\'"?
+    ('X-Content-Security-Policy', 'X_CONTENT_SECURITY_POLICY',
+     'default-src \'self\''),
+    # X-WebKit-CSP is a temporary name for Content-Security-Policy
+    # in WebKit browsers.
+    ('X-WebKit-CSP', 'X_WEBKIT_CSP', 'default-src \'self\''),
+    # Content-Security-Policy defaults to "default-src 'self'".
+    ('Content-Security-Policy', 'CONTENT_SECURITY_POLICY',
+     'default-src \'self\''),
+)
+
+
+class PrefixTrie(object):
+    """
+    Maps string prefixes to values, finding the value of the longest prefix
+    of a string in a single walk over it.
+    """
+    def __init__(self, items=(), default=None):
+        self.root = {}
+        self.default = default
+        for prefix, value in items:
+            self.add(prefix, value)
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = value  # Characters are never None.
+
+    def match(self, string):
+        node = self.root
+        value = node.get(None, self.default)
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
+
 
 class CSPMiddleware:
     """
@@ -62,6 +597,13 @@ class CSPMiddleware:
     ``X_CONTENT_SECURITY_POLICY`` or ``CONTENT_SECURITY_POLICY`` in your
     settings. Set it to None to avoid adding a header completely.
 
+    Policies for some paths may be changed with ``CSP_PATH_OVERRIDES``, a
+    dict mapping path prefixes to dicts of settings to override, e.g.
+    ``{'/admin/': {'CONTENT_SECURITY_POLICY': None}}``; the longest matching
+    prefix wins. Headers are computed once, when the middleware is created.
+    Views may be exempted with the ``csp_exempt`` decorator, headers that are
+    already set on a response are kept.
+
     TODO:
     -- Update to match changes in the standard (particularly
        X-Content-Security-Policy and X-WebKit-CSP should be removed).
@@ -69,41 +611,49 @@ class CSPMiddleware:
        send the same headers for WebKit and Gecko and deduce X-Frame-Options
        from it?
     -- Good collection of other options: http://drupal.org/project/seckit.
-    -- Exempt decorator.
     """
+    def __init__(self):
+        overrides = getattr(settings, 'CSP_PATH_OVERRIDES', {})
+        self.headers = PrefixTrie(
+            ((prefix, self.resolve_headers(values))
+             for prefix, values in overrides.items()),
+            default=self.resolve_headers({}))
+
+    def resolve_headers(self, overrides):
+        """
+        Tuple of (header, value) pairs to set, with some settings overridden.
+        """
+        headers = []
+        for header, setting, default in CSP_HEADERS:
+            value = overrides.get(setting, getattr(settings, setting, default))
+            if value is not None:
+                if header == 'X-Frame-Options':
+                    value = value.upper()
+                headers.append((header, value))
+        return tuple(headers)
+
     def process_response(self, request, response):
 
         # Don't set it if there is an exempt.
         if getattr(response, 'csp_exempt', False):
             return response
 
-        # X-Frame-Options defaults to "SAMEORIGIN" (explicitely setting
-        # to None disables).
-        x_frame_options = getattr(
-            settings, 'X_FRAME_OPTIONS', 'SAMEORIGIN').upper()
-        if x_frame_options is not None and 'X-Frame-Options' not in response:
-            response['X-Frame-Options'] = x_frame_options
-
-        # TODO: Should X-Content-Security-Policy now default to
-        #       "allow: 'self'" or "default-src \'self\'"?
-        x_content_security_policy = getattr(
-            settings, 'X_CONTENT_SECURITY_POLICY', 'default-src \'self\'')
-        if (x_content_security_policy is not None and
-                'X-Content-Security-Policy' not in response):
-            response['X-Content-Security-Policy'] = x_content_security_policy
-
-        # X-WebKit-CSP is a temporary name for Content-Security-Policy
-        # in WebKit browsers.
-        x_webkit_csp = getattr(
-            settings, 'X_WEBKIT_CSP', 'default-src \'self\'')
-        if x_webkit_csp is not None and 'X-WebKit-CSP' not in response:
-            response['X-WebKit-CSP'] = x_webkit_csp
-
-        # Content-Security-Policy defaults to "default-src 'self'".
-        content_security_policy = getattr(
-            settings, 'CONTENT_SECURITY_POLICY', 'default-src \'self\'')
-        if (content_security_policy is not None and
-                'Content-Security-Policy' not in response):
-            response['Content-Security-Policy'] = content_security_policy
+        started = instrumentation.start()
+        for header, value in self.headers.match(request.path_info):
+            if header not in response:
+                response[header] = value
+        if started is not None:
+            instrumentation.record('csp', started, 0, 0, 0, response)
+        return response
+
 
+def csp_exempt(view_func):
+    """
+    Makes CSPMiddleware skip responses of the view.
+    """
+    def wrapped_view(*args, **kwargs):
+        response = view_func(*args, **kwargs)
+        response.csp_exempt = True
         return response
+    return functools.wraps(view_func, assigned=available_attrs(view_func))(
+        wrapped_view)
@@ -15,8 +15,33 @@ database backends, instead using a Python dict (primary key --> model instance)
 as storage. Obviously -- such storage is volatile -- the objects need to be
 recreated anew after each application restart.
 
+Instances are kept as they were saved, unless you choose the compact
+``ColumnarStorage`` with the ``volatile_storage`` meta option; it stores field
+values column-wise and only creates instances for objects you retrieve.
+
+Storage contents may be saved with ``manager.dump(path)`` and restored, for
+example when a worker starts, with ``manager.load(path)``; snapshots keep typed
+columns as raw bytes, so loading a ``ColumnarStorage`` is mostly copying.
+Processes forked from a common master may also share a single copy of the
+objects through a ``SharedStorage``, which maps a snapshot file into memory.
+Storages may be used from several threads: queries read from a pinned version
+and writers publish modified copies of the storage, only small writes are made
+in place (and briefly block queries starting meanwhile).
+
 Ihe implementation is partial. Filtering, ordering and aggregation are normally
-delegated to the database, so will mostly not work with this minimal approach.
+delegated to the database, this module reimplements the common cases in Python.
+``values()``, ``values_list()`` and ``aggregate()`` read field values without
+creating instances (``Count``, ``Sum``, ``Avg``, ``Min`` and ``Max`` are
+supported, computed with NumPy over typed columns if it's installed), while
+``annotate()`` can aggregate over related objects of other volatile models.
+Filters are compiled to Python predicates; the common lookups (``exact``,
+``in``, ``contains``, ``gt``, ``isnull``, ``startswith`` and so on), ``Q``
+objects and spans over foreign keys to other volatile models are supported.
+Exact lookups on the primary key and on fields listed in the ``volatile_indexes``
+meta option are answered from hash indexes, without scanning the storage.
+Fields listed in ``volatile_sorted_indexes`` also serve range lookups (``lt``,
+``lte``, ``gt``, ``gte`` and ``range``) and ``order_by()``, so that slicing an
+ordered query set only touches the objects it returns.
 
 In the current you may display a change list, add and edit objects in the
 admin, but not much more.
@@ -31,6 +56,11 @@ How to use it:
         word = models.CharField(max_length=5, primary_key=True)
         value = models.BooleanField()
 
+        class Meta:
+            ordering = ('word',)
+            volatile_indexes = ('value',)
+            volatile_sorted_indexes = ('word',)
+
         def __str__(self):
             return "{} == {}".format(self.word, self.value)
 
@@ -44,18 +74,41 @@ How to use it:
     model.value = False
     model.save()
     print(manager.filter(pk="Maybe"))
+    print(manager.filter(value=True))
+    print(manager.filter(word__lt="P").order_by('-word')[:1])
+    print(manager.filter(Q(word__istartswith="y") | ~Q(value=True)))
 
 
 Coded for Django 1.5, may need some adaptation for newer versions.
 """
+import array
+import bisect
+import contextlib
 import copy
+import gc
+import itertools
+import mmap
 import operator
+import os
+import re
+import struct
+import threading
+import time
 
+from django.core.exceptions import FieldError
 from django.db import IntegrityError, connections
-from django.db.models import Manager, Model
+from django.db.models import Manager, Model, Q, signals
 from django.db.models.base import ModelBase
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet
-from django.utils import six
+from django.utils import six, tree
+from django.utils.six.moves import cPickle as pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def ignore(*args, **kwargs):
@@ -81,34 +134,1197 @@ DB_ALIAS = 'volatile-model-storage'
 # This will be added to the connections under DB_ALIAS.
 DB_WRAPPER = VolatileDatabaseWrapper()
 
+# Lookups that may be answered by sorted indexes.
+RANGE_LOOKUPS = ('lt', 'lte', 'gt', 'gte')
+
+
+def _text(value):
+    return six.text_type(value)
+
+
+def _prepare_text(field, value):
+    return _text(value)
+
+
+def _prepare_itext(field, value):
+    return _text(value).lower()
+
+
+def _prepare_value(field, value):
+    # Lookup value --> field value (ForeignKeys compare the related key).
+    if isinstance(value, Model):
+        return value.pk
+    elif field.rel:
+        return field.rel.get_related_field().to_python(value)
+    return field.to_python(value)
+
+
+def _prepare_in(field, value):
+    values = [_prepare_value(field, v) for v in value]
+    try:
+        return frozenset(values)
+    except TypeError:
+        return values
+
+
+def _prepare_range(field, value):
+    return tuple(_prepare_value(field, v) for v in value)
+
+
+# Supported field lookups: name --> (test(field value, prepared argument),
+# prepare(field, argument)).
+LOOKUPS = {
+    'exact': (lambda v, a: v == a, _prepare_value),
+    'iexact': (lambda v, a: v is not None and _text(v).lower() == a,
+               _prepare_itext),
+    'contains': (lambda v, a: v is not None and a in _text(v), _prepare_text),
+    'icontains': (lambda v, a: v is not None and a in _text(v).lower(),
+                  _prepare_itext),
+    'startswith': (lambda v, a: v is not None and _text(v).startswith(a),
+                   _prepare_text),
+    'istartswith': (
+        lambda v, a: v is not None and _text(v).lower().startswith(a),
+        _prepare_itext),
+    'endswith': (lambda v, a: v is not None and _text(v).endswith(a),
+                 _prepare_text),
+    'iendswith': (
+        lambda v, a: v is not None and _text(v).lower().endswith(a),
+        _prepare_itext),
+    'in': (lambda v, a: v in a, _prepare_in),
+    'gt': (lambda v, a: v is not None and v > a, _prepare_value),
+    'gte': (lambda v, a: v is not None and v >= a, _prepare_value),
+    'lt': (lambda v, a: v is not None and v < a, _prepare_value),
+    'lte': (lambda v, a: v is not None and v <= a, _prepare_value),
+    'range': (lambda v, a: v is not None and a[0] <= v <= a[1],
+              _prepare_range),
+    'isnull': (lambda v, a: (v is None) == a, lambda f, v: bool(v)),
+    'regex': (lambda v, a: v is not None and a.search(_text(v)) is not None,
+              lambda f, v: re.compile(v)),
+    'iregex': (lambda v, a: v is not None and a.search(_text(v)) is not None,
+               lambda f, v: re.compile(v, re.IGNORECASE)),
+}
+
+# Aggregates computed in Python (besides Count).
+AGGREGATES = {
+    'Sum': sum,
+    'Avg': lambda values: float(sum(values)) / len(values),
+    'Min': min,
+    'Max': max,
+}
+
+# Compiled filters: (model, filter signature) --> (predicate, preparers).
+PREDICATES = {}
+
+# The cache is cleared when it grows above this size.
+PREDICATES_SIZE = 1000
+
+
+def get_field(opts, name):
+    """
+    Finds a field by its name, attribute name or the "pk" alias.
+    """
+    if name == 'pk':
+        return opts.pk
+    try:
+        return opts.get_field(name)
+    except FieldDoesNotExist:
+        for field in opts.fields:
+            if field.attname == name:
+                return field
+        raise
+
+
+def filter_signature(node, values):
+    """
+    Shape of a ``Q`` tree that does not depend on the lookup values, which are
+    appended to ``values`` in the order of the tree leaves.
+    """
+    if isinstance(node, tree.Node):
+        return (node.connector, node.negated,
+                tuple(filter_signature(c, values) for c in node.children))
+    lookup, value = node
+    values.append(value)
+    return lookup
+
+
+def compile_filter(model, node):
+    """
+    Compiles a ``Q`` tree to a predicate ``f(obj, values)`` and returns it
+    together with the prepared lookup values to call it with.
+
+    Predicates are cached per model and tree signature, so repeating a filter
+    with different values only prepares the values.
+    """
+    values = []
+    signature = filter_signature(node, values)
+    try:
+        predicate, preparers = PREDICATES[model, signature]
+    except KeyError:
+        preparers = []
+        predicate = _compile_node(model, signature, preparers)
+        if len(PREDICATES) >= PREDICATES_SIZE:
+            PREDICATES.clear()
+        PREDICATES[model, signature] = predicate, preparers
+    return predicate, [prepare(v) for prepare, v in zip(preparers, values)]
+
+
+def _compile_node(model, signature, preparers):
+    # Leaves get consecutive positions in the values list.
+    if not isinstance(signature, tuple):
+        return _compile_lookup(model, signature, preparers)
+    connector, negated, children = signature
+    predicates = [_compile_node(model, c, preparers) for c in children]
+    combine = any if connector == Q.OR else all
+    if negated:
+        return lambda obj, values: not combine(p(obj, values)
+                                               for p in predicates)
+    return lambda obj, values: combine(p(obj, values) for p in predicates)
+
+
+def _compile_lookup(model, lookup, preparers):
+    # "field__related_field__lookup" --> predicate for a single tree leaf.
+    parts = lookup.split(LOOKUP_SEP)
+    kind = parts.pop() if len(parts) > 1 and parts[-1] in LOOKUPS else 'exact'
+    if kind not in LOOKUPS:
+        raise FieldError("Unsupported lookup {}.".format(lookup))
+    attnames, field = resolve_path(model, parts)
+    test, prepare = LOOKUPS[kind]
+    preparers.append(lambda value: prepare(field, value))
+    position = len(preparers) - 1
+    get = path_getter(attnames)
+    return lambda obj, values: test(get(obj), values[position])
+
+
+def resolve_path(model, parts):
+    """
+    Follows "field__related_field" parts, returning the attributes to get
+    in turn and the final field.
+    """
+    attnames = []
+    for position, part in enumerate(parts):
+        opts = model._meta
+        try:
+            field = get_field(opts, part)
+        except FieldDoesNotExist:
+            raise FieldError("Cannot resolve keyword {} into field (only "
+                             "model fields and forward relations are "
+                             "supported).".format(part))
+        if position == len(parts) - 1:
+            attnames.append(field.attname)
+        elif field.rel:
+            # Follows a relation, the related model should be volatile too.
+            attnames.append(field.name)
+            model = field.rel.to
+        else:
+            raise FieldError("Cannot resolve {} ({} is not a "
+                             "relation).".format(LOOKUP_SEP.join(parts), part))
+    return attnames, field
+
+
+def path_getter(attnames):
+    """
+    Function getting a value through a chain of attributes (None if any
+    related object is missing).
+    """
+    if len(attnames) == 1:
+        return operator.attrgetter(attnames[0])
+
+    def get(obj):
+        for attname in attnames:
+            if obj is None:
+                break
+            obj = getattr(obj, attname)
+        return obj
+    return get
+
+
+def aggregate_values(aggregate, values):
+    """
+    Computes an aggregate (``Count``, ``Sum``, ``Avg``, ``Min`` or ``Max``)
+    over a sequence of values; uses NumPy for typed arrays if it's installed.
+    """
+    name = aggregate.name
+    if name == 'Count' and aggregate.extra.get('distinct'):
+        return len(set(v for v in values if v is not None))
+    if numpy is not None and isinstance(values, (array.array, numpy.ndarray)):
+        if isinstance(values, array.array):
+            values = numpy.frombuffer(values, dtype=values.typecode)
+        if name == 'Count':
+            return len(values)
+        elif not len(values):
+            return None
+        result = {
+            'Sum': values.sum, 'Avg': values.mean,
+            'Min': values.min, 'Max': values.max,
+        }[name]()
+        return result.item()
+    values = [v for v in values if v is not None]
+    if name == 'Count':
+        return len(values)
+    elif name not in AGGREGATES:
+        raise NotImplementedError(
+            "Only {} are supported.".format(', '.join(sorted(AGGREGATES))))
+    elif not values:
+        return None
+    return AGGREGATES[name](values)
+
+
+class HashIndex(object):
+    """
+    Maps values of a single field to sets of primary keys.
+
+    The value indexed for each key is remembered, so an entry can be dropped
+    or moved even after the stored instance has been modified in place.
+    """
+    def __init__(self, attname):
+        self.attname = attname
+        self.buckets = {}  # Field value --> set of primary keys.
+        self.values = {}  # Primary key --> indexed field value.
+
+    def add(self, pk, obj):
+        value = getattr(obj, self.attname)
+        self.buckets.setdefault(value, set()).add(pk)
+        self.values[pk] = value
+
+    def remove(self, pk):
+        value = self.values.pop(pk)
+        bucket = self.buckets[value]
+        bucket.discard(pk)
+        if not bucket:
+            del self.buckets[value]
+
+    def lookup(self, value):
+        return self.buckets.get(value, frozenset())
+
+    def copy(self):
+        index = HashIndex(self.attname)
+        index.buckets = dict((value, set(pks))
+                             for value, pks in six.iteritems(self.buckets))
+        index.values = dict(self.values)
+        return index
+
+    def rebuild(self, pairs):
+        """
+        Replaces the contents with (primary key, value) pairs.
+        """
+        self.buckets, self.values = {}, {}
+        for pk, value in pairs:
+            self.buckets.setdefault(value, set()).add(pk)
+            self.values[pk] = value
+
+
+class SortedIndex(object):
+    """
+    Keeps primary keys ordered by values of a single field.
+
+    Values and keys are held in two parallel lists maintained with bisect,
+    keys with equal values are ordered by themselves. Objects with a null
+    value are not ordered, they come first in the ascending order.
+    """
+    def __init__(self, attname):
+        self.attname = attname
+        self.keys = []  # Sorted field values.
+        self.pks = []  # Primary keys in the order of values.
+        self.nulls = set()  # Primary keys of objects with null values.
+        self.values = {}  # Primary key --> indexed field value.
+
+    def __len__(self):
+        return len(self.values)
+
+    def _position(self, value, pk):
+        # Runs of equal values are sorted by the primary key.
+        low = bisect.bisect_left(self.keys, value)
+        high = bisect.bisect_right(self.keys, value, low)
+        return bisect.bisect_left(self.pks, pk, low, high)
+
+    def add(self, pk, obj):
+        value = getattr(obj, self.attname)
+        if value is None:
+            self.nulls.add(pk)
+        else:
+            position = self._position(value, pk)
+            self.keys.insert(position, value)
+            self.pks.insert(position, pk)
+        self.values[pk] = value
+
+    def remove(self, pk):
+        value = self.values.pop(pk)
+        if value is None:
+            self.nulls.discard(pk)
+        else:
+            position = self._position(value, pk)
+            del self.keys[position]
+            del self.pks[position]
+
+    def lookup(self, value):
+        if value is None:
+            return self.nulls
+        low = bisect.bisect_left(self.keys, value)
+        high = bisect.bisect_right(self.keys, value, low)
+        return set(self.pks[low:high])
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        """
+        Set of keys of objects with values between ``low`` and ``high``
+        (``None`` meaning unbounded).
+        """
+        start, stop = 0, len(self.keys)
+        if low is not None:
+            start = (bisect.bisect_left if include_low else
+                     bisect.bisect_right)(self.keys, low)
+        if high is not None:
+            stop = (bisect.bisect_right if include_high else
+                    bisect.bisect_left)(self.keys, high, start)
+        return set(self.pks[start:stop])
+
+    def rebuild(self, pairs):
+        """
+        Replaces the contents with (primary key, value) pairs, given in the
+        primary key order; they're sorted just once.
+        """
+        pairs = list(pairs)
+        self.values = dict(pairs)
+        self.nulls = set(pk for pk, value in pairs if value is None)
+        if self.nulls:
+            pairs = [pair for pair in pairs if pair[1] is not None]
+        # Stable sort keeps runs of equal values in the primary key order.
+        pairs.sort(key=operator.itemgetter(1))
+        self.keys = [value for pk, value in pairs]
+        self.pks = [pk for pk, value in pairs]
+
+    def copy(self):
+        index = SortedIndex(self.attname)
+        index.keys, index.pks = list(self.keys), list(self.pks)
+        index.nulls, index.values = set(self.nulls), dict(self.values)
+        return index
+
+    def ordered(self, reverse=False):
+        """
+        Yields (value, primary key) pairs in the order of values.
+        """
+        nulls = ((None, pk) for pk in self.nulls)
+        if reverse:
+            values = six.moves.zip(reversed(self.keys), reversed(self.pks))
+            return itertools.chain(values, nulls)
+        else:
+            return itertools.chain(nulls, six.moves.zip(self.keys, self.pks))
+
+
+class PrimaryKeyIndex(object):
+    """
+    Sorted list of primary keys, serves the same queries as ``SortedIndex``.
+
+    Keys are usually added in increasing order, so adding one is mostly an
+    append.
+    """
+    def __init__(self, attname):
+        self.attname = attname
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def add(self, pk):
+        keys = self.keys
+        if not keys or pk > keys[-1]:
+            keys.append(pk)
+        else:
+            bisect.insort(keys, pk)
+
+    def remove(self, pk):
+        del self.keys[bisect.bisect_left(self.keys, pk)]
+
+    def rebuild(self, pks):
+        self.keys = sorted(pks)
+
+    def copy(self):
+        index = PrimaryKeyIndex(self.attname)
+        index.keys = list(self.keys)
+        return index
+
+    def lookup(self, value):
+        position = bisect.bisect_left(self.keys, value)
+        if position < len(self.keys) and self.keys[position] == value:
+            return set([value])
+        return set()
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        start, stop = 0, len(self.keys)
+        if low is not None:
+            start = (bisect.bisect_left if include_low else
+                     bisect.bisect_right)(self.keys, low)
+        if high is not None:
+            stop = (bisect.bisect_right if include_high else
+                    bisect.bisect_left)(self.keys, high, start)
+        return set(self.keys[start:stop])
+
+    def ordered(self, reverse=False):
+        keys = reversed(self.keys) if reverse else self.keys
+        return ((pk, pk) for pk in keys)
+
+
+class VolatileStorage(dict):
+    """
+    The class-wide storage dict (primary key --> model instance) that keeps
+    field indexes in sync with its contents.
+
+    Storing an instance under a key that is already present re-indexes it,
+    so updates are just another assignment. Keys are kept sorted in a primary
+    key index (also used for ordering and ranges) and iterated in that order;
+    the largest integer key is tracked for auto-incrementing.
+    """
+    def __init__(self, model, indexes=(), sorted_indexes=()):
+        super(VolatileStorage, self).__init__()
+        self.model = model
+        pk_attname = model._meta.pk.attname
+        self.pk_index = PrimaryKeyIndex(pk_attname)
+        self.max_pk = -1
+        self.indexes = dict((index.attname, index) for index in indexes)
+        self.sorted_indexes = dict((index.attname, index)
+                                   for index in sorted_indexes)
+        self.sorted_indexes[pk_attname] = self.pk_index
+        self.all_indexes = [index for index in
+                            itertools.chain(indexes, sorted_indexes)
+                            if index.attname != pk_attname]
+
+    # Object to evaluate filters on, may be lighter than the instance.
+    row = dict.__getitem__
+
+    def __iter__(self):
+        return iter(self.pk_index)
+
+    def __setitem__(self, pk, obj):
+        if pk in self:
+            for index in self.all_indexes:
+                index.remove(pk)
+        else:
+            self.pk_index.add(pk)
+            if isinstance(pk, six.integer_types) and pk > self.max_pk:
+                self.max_pk = pk
+        for index in self.all_indexes:
+            index.add(pk, obj)
+        self._put(pk, obj)
+
+    def __delitem__(self, pk):
+        self._pop(pk)
+        self.pk_index.remove(pk)
+        for index in self.all_indexes:
+            index.remove(pk)
+
+    def _put(self, pk, obj):
+        super(VolatileStorage, self).__setitem__(pk, obj)
+
+    def _pop(self, pk):
+        super(VolatileStorage, self).__delitem__(pk)
+
+    def copy(self):
+        """
+        An independent storage with the same contents and indexes (stored
+        instances are shared), see ``VersionedStorage``.
+        """
+        storage = self.__class__.__new__(self.__class__)
+        # Raw values, ColumnarStorage would create instances.
+        dict.update(storage, dict.items(self))
+        storage.__dict__.update(self.__dict__)
+        copies = dict((id(index), index.copy()) for index in self.all_indexes)
+        storage.pk_index = self.pk_index.copy()
+        storage.indexes = dict((attname, copies[id(index)]) for attname, index
+                               in six.iteritems(self.indexes))
+        storage.sorted_indexes = dict(
+            (attname, copies.get(id(index), storage.pk_index))
+            for attname, index in six.iteritems(self.sorted_indexes))
+        storage.all_indexes = [copies[id(index)] for index in self.all_indexes]
+        return storage
+
+    def empty(self):
+        """
+        A storage of the same kind, with the same indexes but no contents.
+        """
+        pk_attname = self.pk_index.attname
+        return self.__class__(
+            self.model,
+            [type(index)(index.attname)
+             for index in six.itervalues(self.indexes)],
+            [type(index)(attname)
+             for attname, index in six.iteritems(self.sorted_indexes)
+             if attname != pk_attname])
+
+    def allocate_pk(self):
+        """
+        Next auto-incremented primary key.
+        """
+        self.max_pk += 1
+        return self.max_pk
+
+    def dump_columns(self):
+        """
+        Field values as a dict of columns (attribute name --> typed array or
+        list) with rows in the primary key order.
+        """
+        objs = [dict.__getitem__(self, pk) for pk in self]
+        columns = {}
+        for field in self.model._meta.fields:
+            values = [getattr(obj, field.attname) for obj in objs]
+            typecode = COLUMN_TYPECODES.get(field.get_internal_type())
+            if typecode is not None and not field.null:
+                try:
+                    values = array.array(typecode, values)
+                except (TypeError, OverflowError):
+                    pass
+            columns[field.attname] = values
+        return columns
+
+    def load_columns(self, columns):
+        """
+        Replaces the contents with rows given as by ``dump_columns()``; no
+        signals are sent and indexes are rebuilt in bulk.
+        """
+        pk_attname = self.pk_index.attname
+        pks = list(columns[pk_attname])
+        dict.clear(self)
+        self._load_rows(pks, columns)
+        self.pk_index.rebuild(pks)
+        integer_pks = [pk for pk in pks
+                       if isinstance(pk, six.integer_types)]
+        self.max_pk = max(integer_pks) if integer_pks else -1
+        for index in self.all_indexes:
+            index.rebuild(six.moves.zip(pks, columns[index.attname]))
+
+    def _load_rows(self, pks, columns):
+        model = self.model
+        fields = model._meta.fields
+        rows = [columns[field.attname] for field in fields]
+        for position, field in enumerate(fields):
+            if getattr(rows[position], 'typecode', None) == 'b':
+                rows[position] = [bool(value) for value in rows[position]]
+        for pk, values in six.moves.zip(pks, six.moves.zip(*rows)):
+            obj = model(*values)
+            obj._state.adding = False
+            obj._state.db = DB_ALIAS
+            obj._storage_pk = pk
+            dict.__setitem__(self, pk, obj)
+
+
+# Array type codes for non-nullable fields that may be stored in typed
+# columns of the compact storage, other fields use lists.
+COLUMN_TYPECODES = {
+    'AutoField': 'l',
+    'BigIntegerField': 'l',
+    'BooleanField': 'b',
+    'FloatField': 'd',
+    'IntegerField': 'l',
+    'PositiveIntegerField': 'l',
+    'PositiveSmallIntegerField': 'l',
+    'SmallIntegerField': 'l',
+}
+
+
+class ColumnarStorage(VolatileStorage):
+    """
+    Compact storage keeping field values column-wise, in typed arrays where
+    possible (see ``COLUMN_TYPECODES``) and lists otherwise.
+
+    The underlying dict maps primary keys to row positions; model instances
+    are only created when looked up, so each query returns new instances
+    (as with vanilla query sets). Filters and ordering read the columns
+    through ``ColumnarRow`` views. Positions of deleted rows are reused.
+
+    Enable it with ``volatile_storage = ColumnarStorage`` in ``Meta``.
+    """
+    def __init__(self, model, indexes=(), sorted_indexes=()):
+        super(ColumnarStorage, self).__init__(model, indexes, sorted_indexes)
+        self.model = model
+        fields = model._meta.fields
+        self.attnames = [field.attname for field in fields]
+        self.columns = [self._column(field) for field in fields]
+        self.column_map = dict(zip(self.attnames, self.columns))
+        self.booleans = [position for position, column in
+                         enumerate(self.columns)
+                         if getattr(column, 'typecode', None) == 'b']
+        self.pk_column = self.column_map[model._meta.pk.attname]
+        self.size = 0  # Number of allocated rows.
+        self.free_rows = []
+
+    def _column(self, field):
+        typecode = COLUMN_TYPECODES.get(field.get_internal_type())
+        if field.null or typecode is None:
+            return []
+        return array.array(typecode)
+
+    def __getitem__(self, pk):
+        return self.materialize(dict.__getitem__(self, pk))
+
+    def row(self, pk):
+        return ColumnarRow(self, dict.__getitem__(self, pk))
+
+    def get(self, pk, default=None):
+        return self[pk] if pk in self else default
+
+    def values(self):
+        return [self[pk] for pk in self]
+
+    def items(self):
+        return [(pk, self[pk]) for pk in self]
+
+    def copy(self):
+        storage = super(ColumnarStorage, self).copy()
+        storage.columns = [column[:] for column in self.columns]
+        storage.column_map = dict(zip(self.attnames, storage.columns))
+        storage.booleans = list(self.booleans)
+        storage.pk_column = storage.column_map[self.model._meta.pk.attname]
+        storage.free_rows = list(self.free_rows)
+        return storage
+
+    def materialize(self, position):
+        """
+        Creates a model instance from a row.
+        """
+        values = [column[position] for column in self.columns]
+        for index in self.booleans:
+            values[index] = bool(values[index])
+        obj = self.model(*values)
+        obj._state.adding = False
+        obj._state.db = DB_ALIAS
+        obj._storage_pk = self.pk_column[position]
+        return obj
+
+    def _put(self, pk, obj):
+        position = dict.get(self, pk)
+        if position is None:
+            if self.free_rows:
+                position = self.free_rows.pop()
+            else:
+                position = self.size
+                self.size += 1
+        for index, attname in enumerate(self.attnames):
+            value = getattr(obj, attname)
+            column = self.columns[index]
+            try:
+                if position == len(column):
+                    column.append(value)
+                else:
+                    column[position] = value
+            except TypeError:
+                # A value that does not fit the array (such as None).
+                self._demote(index)
+                self.columns[index][position:position + 1] = [value]
+        dict.__setitem__(self, pk, position)
+
+    def _pop(self, pk):
+        position = dict.pop(self, pk)
+        for column in self.columns:
+            if isinstance(column, list):
+                column[position] = None
+        self.free_rows.append(position)
+
+    def dump_columns(self):
+        positions = [dict.__getitem__(self, pk) for pk in self]
+        if positions == list(range(self.size)):
+            return dict(zip(self.attnames, self.columns))
+        columns = {}
+        for attname, column in zip(self.attnames, self.columns):
+            values = (column[position] for position in positions)
+            if isinstance(column, array.array):
+                columns[attname] = array.array(column.typecode, values)
+            else:
+                columns[attname] = list(values)
+        return columns
+
+    def _load_rows(self, pks, columns):
+        # Columns are adopted as they are, row positions follow the keys.
+        self.columns = [columns[attname] for attname in self.attnames]
+        self.column_map = dict(zip(self.attnames, self.columns))
+        self.booleans = [position for position, column in
+                         enumerate(self.columns)
+                         if getattr(column, 'typecode', None) == 'b']
+        self.pk_column = self.column_map[self.model._meta.pk.attname]
+        self.size = len(pks)
+        self.free_rows = []
+        dict.update(self, six.moves.zip(pks, range(len(pks))))
+
+    def _demote(self, index):
+        # Replaces a typed column with a list.
+        column = list(self.columns[index])
+        self.columns[index] = column
+        self.column_map[self.attnames[index]] = column
+        self.booleans = [i for i in self.booleans if i != index]
+        if self.attnames[index] == self.model._meta.pk.attname:
+            self.pk_column = column
+
+
+class ColumnarRow(object):
+    """
+    Attribute access to a single row of a ``ColumnarStorage``, anything that
+    is not a column (such as related objects) comes from a model instance.
+    """
+    __slots__ = ('storage', 'position')
+
+    def __init__(self, storage, position):
+        self.storage = storage
+        self.position = position
+
+    def __getattr__(self, name):
+        storage = self.storage
+        try:
+            column = storage.column_map[name]
+        except KeyError:
+            return getattr(storage.materialize(self.position), name)
+        return column[self.position]
+
+
+class VersionedStorage(object):
+    """
+    Thread-safe handle to a local storage (the ``model.storage`` of models
+    using ``VolatileStorage`` or ``ColumnarStorage``).
+
+    Query sets pin the current version while they are evaluated, writers are
+    serialized (so allocating auto-incremented keys is atomic). Writers apply
+    their changes to a copy, which is published once the whole write
+    succeeds; readers keep their version and are not blocked. Writes of up to
+    ``in_place_size`` objects are made in place if no readers have the
+    version pinned, then readers starting meanwhile wait for them (about as
+    long as re-indexing that many objects takes).
+
+    Instances of the default storage are shared between versions, so changes
+    made to them outside of ``save()`` are seen by all versions.
+    """
+    in_place_size = 100
+
+    def __init__(self, version):
+        self.version = version
+        self.readers = 0  # Evaluations pinning the current version.
+        self.lock = threading.RLock()  # Serializes writers.
+        self.pin_lock = threading.RLock()  # Held for pinning or in-place writes.
+
+    def __len__(self):
+        return len(self.version)
+
+    def __contains__(self, pk):
+        return pk in self.version
+
+    def __iter__(self):
+        return iter(self.version)
+
+    def __getitem__(self, pk):
+        return self.version[pk]
+
+    def __getattr__(self, name):
+        # Reading methods are delegated to the current version (not pinned).
+        return getattr(self.version, name)
+
+    def current(self):
+        """
+        The current version, for inspection; use ``pin()`` to read from it.
+        """
+        return self.version
+
+    def pin(self):
+        """
+        The current version, kept unchanged until ``unpin()`` is called.
+        """
+        with self.pin_lock:
+            self.readers += 1
+            return self.version
+
+    def unpin(self, version):
+        with self.pin_lock:
+            if version is self.version:
+                self.readers -= 1
+
+    @contextlib.contextmanager
+    def writing(self, size=None):
+        """
+        Context giving the version to modify, see the class description;
+        ``size`` is the number of objects to write (None if unknown).
+        """
+        with self.lock:
+            if size is not None and size <= self.in_place_size:
+                self.pin_lock.acquire()
+                if not self.readers:
+                    try:
+                        yield self.version
+                    finally:
+                        self.pin_lock.release()
+                    return
+                self.pin_lock.release()
+            version = self.version.copy()
+            yield version
+            with self.pin_lock:
+                self.version, self.readers = version, 0
+
+    def load_columns(self, columns):
+        # All contents are replaced, so the current version isn't copied.
+        with self.lock:
+            version = self.version.empty()
+            version.load_columns(columns)
+            with self.pin_lock:
+                self.version, self.readers = version, 0
+
+
+# Marks the start of storage snapshots.
+SNAPSHOT_MAGIC = b'VMS1'
+
+# Header size field format (snapshot header is a pickled dict).
+SNAPSHOT_HEADER = struct.Struct('<Q')
+
+
+def write_snapshot(file, model, columns, random_access=False):
+    """
+    Writes columns to a binary snapshot: a pickled header with the model
+    label and column layout, followed by 8-byte aligned column data. Typed
+    arrays are written as raw bytes, other columns as pickled lists, or with
+    ``random_access`` as separately pickled cells preceded by their count
+    and offsets.
+    """
+    data, layout, offset = [], [], 0
+    for attname, column in sorted(six.iteritems(columns)):
+        if isinstance(column, array.array):
+            kind, typecode, chunk = 'array', column.typecode, _array_bytes(column)
+        elif random_access:
+            kind, typecode = 'cells', None
+            cells = [pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                     for value in column]
+            offsets = [0]
+            for cell in cells:
+                offsets.append(offsets[-1] + len(cell))
+            chunk = struct.pack('<{}q'.format(len(offsets) + 1), len(cells),
+                                *offsets) + b''.join(cells)
+        else:
+            kind, typecode = 'pickle', None
+            chunk = pickle.dumps(list(column), pickle.HIGHEST_PROTOCOL)
+        layout.append((attname, kind, typecode, offset, len(chunk)))
+        padding = -len(chunk) % 8
+        data.append(chunk + b'\0' * padding)
+        offset += len(chunk) + padding
+    header = pickle.dumps({
+        'model': model._meta.db_table,
+        'columns': layout,
+    }, pickle.HIGHEST_PROTOCOL)
+    header += b'\0' * (-(len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size +
+                         len(header)) % 8)
+    file.write(SNAPSHOT_MAGIC)
+    file.write(SNAPSHOT_HEADER.pack(len(header)))
+    file.write(header)
+    for chunk in data:
+        file.write(chunk)
+
+
+def read_snapshot(buffer, model, mapped=False):
+    """
+    Reads columns from a snapshot held in a bytes-like object (possibly an
+    ``mmap``).
+
+    With ``mapped`` typed arrays and cells are not copied, but read from the
+    buffer on access (see ``MappedArray`` and ``MappedCells``).
+    """
+    start = len(SNAPSHOT_MAGIC)
+    if buffer[:start] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a volatile storage snapshot.")
+    length, = SNAPSHOT_HEADER.unpack_from(buffer, start)
+    start += SNAPSHOT_HEADER.size
+    header = pickle.loads(buffer[start:start + length])
+    start += length
+    if header['model'] != model._meta.db_table:
+        raise ValueError("Snapshot of {} can't be loaded into {}.".format(
+            header['model'], model._meta.db_table))
+    columns = {}
+    for attname, kind, typecode, offset, size in header['columns']:
+        offset += start
+        if mapped and kind == 'array':
+            columns[attname] = MappedArray(buffer, offset, size, typecode)
+        elif kind == 'array':
+            columns[attname] = _array_from_bytes(
+                typecode, buffer[offset:offset + size])
+        elif kind == 'cells':
+            cells = MappedCells(buffer, offset)
+            columns[attname] = cells if mapped else list(cells)
+        else:
+            columns[attname] = pickle.loads(buffer[offset:offset + size])
+    missing = set(f.attname for f in model._meta.fields) - set(columns)
+    if missing:
+        raise ValueError("Snapshot is missing fields: {}.".format(
+            ', '.join(sorted(missing))))
+    return columns
+
+
+class MappedArray(object):
+    """
+    Read-only typed column of a snapshot, values are unpacked from the buffer
+    on access.
+    """
+    __slots__ = ('buffer', 'start', 'size', 'typecode', 'item')
+
+    def __init__(self, buffer, start, size, typecode):
+        self.buffer = buffer
+        self.start = start
+        self.typecode = typecode
+        self.item = struct.Struct(typecode)
+        self.size = size // self.item.size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[p] for p in range(*position.indices(self.size))]
+        if position < 0:
+            position += self.size
+        if not 0 <= position < self.size:
+            raise IndexError("Mapped column index out of range.")
+        return self.item.unpack_from(
+            self.buffer, self.start + position * self.item.size)[0]
+
+    def __iter__(self):
+        # Bulk reads are cheaper through a temporary array.
+        end = self.start + self.size * self.item.size
+        return iter(_array_from_bytes(self.typecode,
+                                      self.buffer[self.start:end]))
+
+
+class MappedCells(object):
+    """
+    Read-only column of separately pickled values, a value is unpickled from
+    the buffer on each access.
+    """
+    __slots__ = ('buffer', 'start', 'size', 'data')
+
+    offsets = struct.Struct('<2q')
+
+    def __init__(self, buffer, start):
+        self.buffer = buffer
+        self.size, = struct.unpack_from('<q', buffer, start)
+        self.start = start + 8  # Cell offsets, one more than cells.
+        self.data = self.start + (self.size + 1) * 8
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.size
+        if not 0 <= position < self.size:
+            raise IndexError("Mapped column index out of range.")
+        low, high = self.offsets.unpack_from(self.buffer,
+                                             self.start + position * 8)
+        return pickle.loads(self.buffer[self.data + low:self.data + high])
+
+    def __iter__(self):
+        return (self[position] for position in range(self.size))
+
+
+class MappedStorage(ColumnarStorage):
+    """
+    A read-only version of a ``SharedStorage``, with columns read from a
+    mapped snapshot.
+    """
+    def __setitem__(self, pk, obj):
+        raise TypeError("Shared storage is read-only, publish a new version "
+                        "instead.")
+
+    __delitem__ = __setitem__
+
+
+class SharedStorage(object):
+    """
+    Read-mostly storage kept in a snapshot file mapped into memory, so that
+    forked worker processes share the pages of a single copy.
+
+    The master process publishes the contents (with ``publish(objs)`` or
+    ``manager.load(path)``), which writes a new snapshot next to ``path``
+    and atomically renames it over the previous one. Every process maps the
+    current snapshot and checks for a newer version at most once per
+    ``check_interval`` seconds, when a query set is evaluated. Evaluations keep
+    the version they started with, so a swap never affects a running query.
+
+    Typed columns and cells are read from the mapping without copying; the
+    key to row dict and indexes are built per version in each process
+    (before forking, they're shared as long as they are not written to).
+    Use the storage by setting, for example::
+
+        volatile_storage = functools.partial(SharedStorage,
+                                             path='/dev/shm/rates')
+
+    in the model's ``Meta``.
+    """
+    def __init__(self, model, indexes=(), sorted_indexes=(), path=None,
+                 check_interval=1.0):
+        if path is None:
+            raise ValueError("SharedStorage needs a snapshot path.")
+        self.model = model
+        self.path = path
+        self.check_interval = check_interval
+        self.indexes = [(type(index), index.attname) for index in indexes]
+        self.sorted_indexes = [(type(index), index.attname)
+                               for index in sorted_indexes]
+        self.version = None
+        self.version_stat = None
+        self.checked = 0
+
+    def __len__(self):
+        return len(self.current())
+
+    def __contains__(self, pk):
+        return pk in self.current()
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __getitem__(self, pk):
+        return self.current()[pk]
+
+    def __getattr__(self, name):
+        # Reading methods are delegated to the current version.
+        return getattr(self.current(), name)
+
+    def current(self):
+        """
+        The current version, remapped if a newer one has been published.
+        """
+        now = time.time()
+        if self.version is None or now - self.checked >= self.check_interval:
+            self.checked = now
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                stat = None
+            else:
+                stat = stat.st_ino, stat.st_size, stat.st_mtime
+            if self.version is None or stat != self.version_stat:
+                self.version = self._map(stat is not None)
+                self.version_stat = stat
+        return self.version
+
+    def pin(self):
+        # Versions are immutable, there is nothing to keep them from.
+        return self.current()
+
+    def unpin(self, version):
+        pass
+
+    @contextlib.contextmanager
+    def writing(self, size=None):
+        # Versions are read-only, writes raise TypeError.
+        yield self.current()
+
+    def _map(self, exists):
+        version = MappedStorage(
+            self.model,
+            [index(attname) for index, attname in self.indexes],
+            [index(attname) for index, attname in self.sorted_indexes])
+        if exists:
+            with open(self.path, 'rb') as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            version.load_columns(read_snapshot(buffer, self.model, True))
+        return version
+
+    def load_columns(self, columns):
+        """
+        Publishes a new version with the given columns.
+        """
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temporary, 'wb') as file:
+            write_snapshot(file, self.model, columns, random_access=True)
+        os.rename(temporary, self.path)
+        self.version = None
+
+    def publish(self, objs):
+        """
+        Publishes a new version containing the given (unsaved) objects,
+        auto-incremented keys are assigned as on save.
+        """
+        storage = ColumnarStorage(self.model)
+        for obj in objs:
+            if obj.pk is None:
+                setattr(obj, obj._meta.pk.attname, storage.allocate_pk())
+            storage[obj.pk] = obj
+        self.load_columns(storage.dump_columns())
+
+
+def _array_bytes(column):
+    return column.tobytes() if six.PY3 else column.tostring()
+
+
+def _array_from_bytes(typecode, chunk):
+    column = array.array(typecode)
+    if six.PY3:
+        column.frombytes(chunk)
+    else:
+        column.fromstring(chunk)
+    return column
+
+
+class VolatileQuery(object):
+    """
+    Stands in for the few ``Query`` attributes that admin reads directly.
+    """
+    select_related = True
+    where = None
+
+    def __init__(self):
+        self.order_by = []
+
 
 class VolatileQuerySet(object):
     """
     A partial implementation of the ``QuerySet`` API using ordering-sorted dict
     as the storage.
 
-    Note that it does not postpone processing, creating or deleting models
-    won't be reflected in existing query sets. Also note that unlike with
-    vanilla query sets you don't get multiple copies of model instances --
-    all queries return the same (last stored) instance.
+    Like a ``QuerySet`` it is lazy: filtering, ordering and slicing only
+    record what should be retrieved, the storage is consulted once the query
+    set is iterated, counted, checked for existence or indexed. Results are
+    streamed, so slices and ``exists()`` stop as soon as they have enough
+    objects. Note that unlike with vanilla query sets you don't get multiple
+    copies of model instances -- all queries return the same (last stored)
+    instance (unless the model uses ``ColumnarStorage``). Each evaluation
+    reads from a single storage version, pinned while it runs, so concurrent
+    writes don't affect it.
+
+    Ordering uses a sorted index on the first ordering field if there is one
+    and falls back to sorting the matching objects otherwise.
     """
     def __init__(self, model):
         self.model = model
-        self.storage = model.storage  # The underlying class-wide storage.
-        self.items = copy.copy(self.storage)  # Filtered collection.
+        self.filters = []  # (negate, lookup callables) pairs.
+        self.ordering = None  # Field names, model's ordering if None.
+        self.low_mark, self.high_mark = 0, None  # Slice bounds.
+        self.annotations = []  # (alias, aggregate) pairs.
+        self.value_fields = None  # Field names for values(), values_list().
+        self.value_kind = None  # dict, tuple or flat.
+        self._result_cache = None
         # We'd like to reuse a few of QuerySet methods.
         self.db = None
         # Some parts of admin use QuerySet.query directly.
-        self.query = type('Query', (), {})
-        self.query.select_related = True
-        self.query.order_by = []
-        self.query.where = None
+        self.query = VolatileQuery()
         # Ensure the fake database entry exists.
         setattr(connections._connections, DB_ALIAS, DB_WRAPPER)
 
     def __getitem__(self, k):
-        # This may support a bit more slices than QuerySet.
-        return self.items.values()[k]
+        # This may support a bit more slices than QuerySet (negative indexes
+        # and steps evaluate the whole query set).
+        if self._result_cache is not None:
+            return self._result_cache[k]
+        if isinstance(k, slice):
+            if ((k.start or 0) < 0 or (k.stop or 0) < 0 or
+                    (k.step or 1) < 0):
+                return list(self)[k]
+            clone = self._clone()
+            clone._set_limits(k.start, k.stop)
+            return list(clone)[::k.step] if k.step else clone
+        if k < 0:
+            return list(self)[k]
+        clone = self._clone()
+        clone._set_limits(k, k + 1)
+        try:
+            return next(clone.iterator())
+        except StopIteration:
+            raise IndexError("Volatile query set index out of range.")
+
+    def __iter__(self):
+        self._fetch_all()
+        return iter(self._result_cache)
 
     def __repr__(self):
         # Use the QuerySet implementation.
@@ -116,23 +1332,315 @@ class VolatileQuerySet(object):
 
     def __len__(self):
         # The size of the filtered collection.
-        return len(self.items)
+        self._fetch_all()
+        return len(self._result_cache)
+
+    def _fetch_all(self):
+        if self._result_cache is None:
+            self._result_cache = list(self.iterator())
+
+    def _set_limits(self, low, high):
+        # Slicing is relative to the current slice, as with QuerySet.
+        if high is not None:
+            if self.high_mark is not None:
+                self.high_mark = min(self.high_mark, self.low_mark + high)
+            else:
+                self.high_mark = self.low_mark + high
+        if low is not None:
+            if self.high_mark is not None:
+                self.low_mark = min(self.high_mark, self.low_mark + low)
+            else:
+                self.low_mark = self.low_mark + low
 
     def iterator(self):
-        # Items are kept sorted properly, so we can just iterate values.
-        return six.itervalues(self.items)
+        # Generator of matching objects (or their values), ordered according
+        # to order_by() or the model's ordering, limited to the slice taken.
+        handle = self.model.storage
+        storage = handle.pin()
+        try:
+            for obj in self._iterate(storage):
+                yield obj
+        finally:
+            handle.unpin(storage)
+
+    def _iterate(self, storage):
+        pks = itertools.islice(self._iterate_pks(storage),
+                               self.low_mark, self.high_mark)
+        annotate = self._annotator()
+        if self.value_kind is not None:
+            return self._iterate_values(storage, pks, annotate)
+        if annotate is None:
+            return (storage[pk] for pk in pks)
+        return (self._annotate(storage, storage[pk], annotate(pk))
+                for pk in pks)
+
+    def _iterate_values(self, storage, pks, annotate):
+        # Values are read from rows, without creating model instances.
+        names = self.value_fields
+        if not names:
+            names = [f.attname for f in self.model._meta.fields]
+            names.extend(alias for alias, aggregate in self.annotations)
+        aliases = set(alias for alias, aggregate in self.annotations)
+        getters = [None if name in aliases else
+                   path_getter(resolve_path(self.model,
+                                            name.split(LOOKUP_SEP))[0])
+                   for name in names]
+        for pk in pks:
+            row = storage.row(pk)
+            annotations = annotate(pk) if annotate is not None else {}
+            values = [annotations[name] if get is None else get(row)
+                      for name, get in zip(names, getters)]
+            if self.value_kind == 'flat':
+                yield values[0]
+            elif self.value_kind == 'tuple':
+                yield tuple(values)
+            else:
+                yield dict(zip(names, values))
+
+    def _annotate(self, storage, obj, annotations):
+        # Stored instances are shared, annotations go on a copy.
+        if obj is storage.row(obj._storage_pk):
+            obj = copy.copy(obj)
+        for alias, value in six.iteritems(annotations):
+            setattr(obj, alias, value)
+        return obj
+
+    def _annotator(self):
+        # Function giving annotation values for a primary key, None if there
+        # are no annotations. Aggregates over objects of other volatile models
+        # referring to this one are grouped by the reference in one pass.
+        if not self.annotations:
+            return None
+        groups = []
+        for alias, aggregate in self.annotations:
+            groups.append((alias, aggregate,
+                           self._annotation_groups(aggregate.lookup)))
+
+        def annotate(pk):
+            return dict((alias, aggregate_values(aggregate, group.get(pk, ())))
+                        for alias, aggregate, group in groups)
+        return annotate
+
+    def _annotation_groups(self, lookup):
+        # "related__field" --> {primary key: list of field values}.
+        name, _, path = lookup.partition(LOOKUP_SEP)
+        for related in self.model._meta.get_all_related_objects():
+            if related.field.related_query_name() == name:
+                break
+        else:
+            raise FieldError("Only aggregates over objects of other volatile "
+                             "models referring to this one are supported "
+                             "({}).".format(lookup))
+        related_model = related.model
+        if path:
+            get = path_getter(resolve_path(related_model,
+                                           path.split(LOOKUP_SEP))[0])
+        else:
+            get = operator.attrgetter(related_model._meta.pk.attname)
+        get_key = operator.attrgetter(related.field.attname)
+        groups = {}
+        handle = related_model.storage
+        storage = handle.pin()
+        try:
+            for pk in storage:
+                row = storage.row(pk)
+                groups.setdefault(get_key(row), []).append(get(row))
+        finally:
+            handle.unpin(storage)
+        return groups
+
+    def _iterate_pks(self, storage):
+        # Keys of matching objects, in order, ignoring the slice bounds.
+        included, excluded, predicates = self._candidates(storage)
+        if included is None:
+            included = candidates = storage
+        else:
+            candidates = self._key_ordered(storage, included)
+        matches = self._matcher(storage, excluded, predicates)
+        ordering = self.ordering
+        if ordering is None:
+            ordering = self.model._meta.ordering
+        if not ordering:
+            return (pk for pk in candidates if matches(pk))
+        keys = [self._ordering_key(name) for name in ordering]
+        attname, reverse = keys[0]
+        index = storage.sorted_indexes.get(attname)
+        # Sorting a handful of candidates beats walking a large index.
+        if index is None or len(included) * 8 < len(index):
+            return iter(self._sorted(
+                storage, (pk for pk in candidates if matches(pk)), keys))
+        return self._iterate_index(
+            storage, index, reverse, keys[1:],
+            lambda pk: pk in included and matches(pk))
+
+    def _key_ordered(self, storage, pks):
+        # Keys from an index lookup (a set) in the primary key order, as they
+        # are stored; a handful of them is sorted rather than walking all.
+        if len(pks) * 8 < len(storage.pk_index):
+            return sorted(pks)
+        return (pk for pk in storage.pk_index if pk in pks)
+
+    def _candidates(self, storage):
+        # Primary keys set to go through (None for all stored objects), a
+        # list of excluded key sets and a list of (negate, predicate, values)
+        # for filters that could not be fully answered by indexes.
+        included, excluded, predicates = None, [], []
+        for negate, lookups, covered, predicate, values in self.filters:
+            if lookups and (covered or not negate):
+                matched = None
+                for lookup in lookups:
+                    pks = lookup(storage)
+                    matched = pks if matched is None else matched & pks
+                if negate:
+                    excluded.append(matched)
+                elif included is None:
+                    included = matched
+                else:
+                    included = included & matched
+            if not covered:
+                predicates.append((negate, predicate, values))
+        return included, excluded, predicates
+
+    def _matcher(self, storage, excluded, predicates):
+        # Tests a candidate key against exclusions and compiled filters.
+        def matches(pk):
+            if any(pk in e for e in excluded):
+                return False
+            if predicates:
+                obj = storage.row(pk)
+                return all(predicate(obj, values) != negate
+                           for negate, predicate, values in predicates)
+            return True
+        return matches
+
+    def _ordering_key(self, name):
+        # Field name with an optional "-" --> (attribute name, descending).
+        reverse = name.startswith('-')
+        name = name.lstrip('-+')
+        try:
+            return get_field(self.model._meta, name).attname, reverse
+        except FieldDoesNotExist:
+            raise ValueError("Only ordering by the model's own fields is "
+                             "supported ({}).".format(name))
+
+    def _sorted(self, storage, pks, keys):
+        # Sorts by the last key first, relying on sort stability; nulls are
+        # placed as in sorted indexes.
+        pks = list(pks)
+        for attname, reverse in reversed(keys):
+            def key(pk):
+                value = getattr(storage.row(pk), attname)
+                return value is not None, value
+            pks.sort(key=key, reverse=reverse)
+        return pks
+
+    def _iterate_index(self, storage, index, reverse, keys, matches):
+        # Walks the index, ordering each run of objects with an equal value
+        # by the remaining keys.
+        pairs = index.ordered(reverse)
+        for value, run in itertools.groupby(pairs, key=lambda pair: pair[0]):
+            pks = [pk for value, pk in run if matches(pk)]
+            if keys and len(pks) > 1:
+                pks = self._sorted(storage, pks, keys)
+            for pk in pks:
+                yield pk
+
+    def all(self):
+        return self._clone()
+
+    def values(self, *fields):
+        clone = self._clone()
+        clone.value_fields, clone.value_kind = fields, 'dict'
+        return clone
+
+    def values_list(self, *fields, **kwargs):
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments to values_list: "
+                            "{}.".format(list(kwargs)))
+        if flat and len(fields) != 1:
+            raise TypeError("'flat' is only valid when values_list is called "
+                            "with exactly one field.")
+        clone = self._clone()
+        clone.value_fields = fields
+        clone.value_kind = 'flat' if flat else 'tuple'
+        return clone
+
+    def aggregate(self, *args, **kwargs):
+        # Aggregates are computed over field values of the matching objects;
+        # with no filters or slicing typed columns are used as they are.
+        for aggregate in args:
+            kwargs[aggregate.default_alias] = aggregate
+        handle = self.model.storage
+        storage = handle.pin()
+        try:
+            return self._aggregate(storage, kwargs)
+        finally:
+            handle.unpin(storage)
+
+    def _aggregate(self, storage, aggregates):
+        result = {}
+        for alias, aggregate in six.iteritems(aggregates):
+            lookup = aggregate.lookup
+            if lookup == '*':
+                result[alias] = self.count()
+                continue
+            attnames, field = resolve_path(self.model,
+                                           lookup.split(LOOKUP_SEP))
+            column = getattr(storage, 'column_map', {}).get(attnames[0])
+            if (len(attnames) == 1 and isinstance(column, array.array) and
+                    not self.filters and self.low_mark == 0 and
+                    self.high_mark is None):
+                values = column[:storage.size]
+                if storage.free_rows:
+                    values = array.array(column.typecode, (
+                        column[dict.__getitem__(storage, pk)]
+                        for pk in storage))
+            else:
+                values = self._clone().values_list(lookup, flat=True)
+                values = list(values.iterator())
+            result[alias] = aggregate_values(aggregate, values)
+        return result
+
+    def annotate(self, *args, **kwargs):
+        # Only aggregates over related volatile objects are supported, the
+        # annotations can't be used for filtering or ordering.
+        clone = self._clone()
+        for aggregate in args:
+            kwargs[aggregate.default_alias] = aggregate
+        clone.annotations = self.annotations + list(six.iteritems(kwargs))
+        return clone
 
     def count(self):
-        # The size of the filtered collection.
-        return len(self.items)
+        # Counts keys without retrieving objects; with no exclusions the
+        # candidate set size is enough.
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        handle = self.model.storage
+        storage = handle.pin()
+        try:
+            included, excluded, predicates = self._candidates(storage)
+            if excluded or predicates:
+                if included is None:
+                    included = storage
+                matches = self._matcher(storage, excluded, predicates)
+                count = sum(1 for pk in included if matches(pk))
+            else:
+                count = len(storage if included is None else included)
+        finally:
+            handle.unpin(storage)
+        count = max(count - self.low_mark, 0)
+        if self.high_mark is not None:
+            count = min(count, self.high_mark - self.low_mark)
+        return count
 
     def get(self, *args, **kwargs):
         # Delegated to filter(), almost the same as QuerySet.get().
         filtered = self.filter(*args, **kwargs)
-        count = filtered.count()
-        if count == 1:
-            return filtered[0]
-        elif count == 0:
+        objs = list(itertools.islice(filtered.iterator(), 2))
+        if len(objs) == 1:
+            return objs[0]
+        elif not objs:
             raise self.model.DoesNotExist()
         else:
             raise self.model.MultipleObjectsReturned()
@@ -151,12 +1659,29 @@ class VolatileQuerySet(object):
         return QuerySet.get_or_create.__func__(self, **kwargs)
 
     def _update(self, values):
-        # This is called from save_base(), which already modified the stored
-        # instance, thus we don't need to do anything.
-        pass
+        # This is called from save_base(); the saved instance is usually the
+        # stored one, but it still has to be re-indexed.
+        with self.model.storage.writing(self.count()) as storage:
+            objs = list(self._iterate(storage))
+            for obj in objs:
+                for field, model, value in values:
+                    setattr(obj, field.attname, value)
+                storage[obj._storage_pk] = obj
+        return len(objs)
+
+    def delete(self):
+        # Django would collect and delete related objects, here we only remove
+        # the matching objects.
+        self._delete(list(self.iterator()))
+        self._result_cache = None
 
     def exists(self):
-        return bool(self.items)
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        # Values (of values_list() with flat=True) may be None.
+        for value in self.iterator():
+            return True
+        return False
 
     def filter(self, *args, **kwargs):
         kwargs['_negate'] = False
@@ -172,59 +1697,134 @@ class VolatileQuerySet(object):
         return self
 
     def order_by(self, *field_names):
-        # TODO: We just ignore the ordering for now.
-        return self
+        # Ordering is applied lazily, once objects are retrieved.
+        assert self.low_mark == 0 and self.high_mark is None, \
+            "Cannot reorder a query once a slice has been taken."
+        for name in field_names:
+            self._ordering_key(name)
+        clone = self._clone()
+        clone.ordering = field_names
+        clone.query = copy.copy(self.query)
+        clone.query.order_by = list(field_names)
+        return clone
 
     def using(self, alias):
         if alias != DB_ALIAS:
             raise ValueError("Only operates on the in-memory storage.")
         return self
 
-    def _clone(self, new_items=None):
-        # Same, but independent, filters.
+    def _clone(self):
+        # Same, but independent, filters; nothing is retrieved.
         clone = copy.copy(self)
-        clone.items = copy.copy(self.items) if new_items is None else new_items
+        clone.filters = list(self.filters)
+        clone._result_cache = None
         return clone
 
     def _store_or_update(self, objs):
         # Bulk create that may also update existing objects and can handle
-        # auto-incrementing ids.
-        storage = self.storage
-        max_pk = storage.keys()[-1] if storage else -1
+        # auto-incrementing ids. Each object costs about as much as updating
+        # the indexes, the storage is never re-sorted.
+        objs = list(objs)
+        with self.model.storage.writing(len(objs)) as storage:
+            for obj in objs:
+                pk = obj.pk
+                if pk is None:
+                    pk = storage.allocate_pk()
+                    setattr(obj, obj._meta.pk.attname, pk)
+                elif pk in storage:
+                    raise IntegrityError("Object with primary key {} already "
+                                         "exists.".format(pk))
+                if hasattr(obj, '_storage_pk'):
+                    del storage[obj._storage_pk]
+                obj._storage_pk = pk
+                storage[pk] = obj
+
+    def _delete(self, objs):
+        # Removes objects from the storage (and thus from its indexes). The
+        # signals are sent outside of the write, as handlers may query.
         for obj in objs:
-            pk = obj.pk
-            if pk is None:
-                max_pk += 1
-                pk = max_pk
-            elif isinstance(pk, six.integer_types) and pk > max_pk:
-                max_pk = pk
-            elif pk in storage:
-                raise IntegrityError("Object with primary key {} already "
-                                     "exists.".format(pk))
-            if hasattr(obj, '_storage_pk'):
+            signals.pre_delete.send(sender=obj.__class__, instance=obj,
+                                    using=DB_ALIAS)
+        with self.model.storage.writing(len(objs)) as storage:
+            for obj in objs:
                 del storage[obj._storage_pk]
-            obj._storage_pk = pk
-            storage[pk] = obj
-        self.storage = sorted(storage)
-        self.items = copy.copy(self.storage)  # TODO: Create after filter.
+                del obj._storage_pk
+        for obj in objs:
+            signals.post_delete.send(sender=obj.__class__, instance=obj,
+                                     using=DB_ALIAS)
+            setattr(obj, obj._meta.pk.attname, None)
+
+    def _index_lookup(self, lookup, value):
+        # Callable taking a storage version and returning the set of primary
+        # keys of stored objects that match the lookup, or None if the lookup
+        # cannot be answered by the indexes. Lookups on the primary key or on
+        # indexed fields, without spanning relations, are considered.
+        name, _, kind = lookup.partition('__')
+        kind = kind or 'exact'
+        opts = self.model._meta
+        if name == 'pk' or name in (opts.pk.name, opts.pk.attname):
+            if kind == 'exact':
+                value = opts.pk.to_python(value)
+                return lambda s: set([value]) if value in s else set()
+            elif kind == 'in':
+                values = [opts.pk.to_python(v) for v in value]
+                return lambda s: set(v for v in values if v in s)
+            return None
+        try:
+            field = get_field(opts, name)
+        except FieldDoesNotExist:
+            return None
+        # Indexes are the same for all versions, only their contents differ.
+        attname = field.attname
+        storage = self.model.storage.current()
+        sorted_index = attname in storage.sorted_indexes
+        if attname in storage.indexes:
+            exact_index = 'indexes'
+        else:
+            exact_index = 'sorted_indexes' if sorted_index else None
+        if exact_index is not None and kind == 'exact':
+            value = _prepare_value(field, value)
+            return lambda s: getattr(s, exact_index)[attname].lookup(value)
+        elif exact_index is not None and kind == 'in':
+            values = [_prepare_value(field, v) for v in value]
+            return lambda s: set().union(*[
+                getattr(s, exact_index)[attname].lookup(v) for v in values])
+        elif exact_index is not None and kind == 'isnull' and value:
+            return lambda s: getattr(s, exact_index)[attname].lookup(None)
+        elif sorted_index and kind == 'range':
+            low, high = [_prepare_value(field, v) for v in value]
+            return lambda s: s.sorted_indexes[attname].range(low, high)
+        elif sorted_index and kind in RANGE_LOOKUPS:
+            value = _prepare_value(field, value)
+            bounds = {
+                'lt': {'high': value, 'include_high': False},
+                'lte': {'high': value},
+                'gt': {'low': value, 'include_low': False},
+                'gte': {'low': value},
+            }[kind]
+            return lambda s: s.sorted_indexes[attname].range(**bounds)
+        return None
 
     def _filter_or_exclude(self, *args, **kwargs):
-        # Could support some more comparisons. Filtering by non-primary-key
-        # fields could also be implemented (mostly with linear cost).
+        # The filter is compiled to a predicate now, but only evaluated when
+        # the query set is; keyword lookups answerable by indexes narrow the
+        # candidates, and if all of them are, the predicate is not needed.
+        assert self.low_mark == 0 and self.high_mark is None, \
+            "Cannot filter a query once a slice has been taken."
         negate = kwargs.pop('_negate')
-        filters = kwargs.keys()
-        if filters == []:
-            return self._clone()
-        elif filters == ['pk'] or filters == [self.model._meta.pk.name]:
-            items = self.items
-            comparison = (operator.ne if negate else operator.eq)
-            value = kwargs.values()[0]
-            filtered_items = {
-                pk: items[pk] for pk in items if comparison(pk, value)}
-            return self._clone(filtered_items)
-        else:
-            raise ValueError("Only filtering by primary key is "
-                             "supported ({}).".format(kwargs))
+        clone = self._clone()
+        if args or kwargs:
+            node = Q(*args, **kwargs)
+            predicate, values = compile_filter(self.model, node)
+            lookups = []
+            for lookup, value in six.iteritems(kwargs):
+                index_lookup = self._index_lookup(lookup, value)
+                if index_lookup is not None:
+                    lookups.append(index_lookup)
+            covered = not args and len(lookups) == len(kwargs)
+            clone.filters.append(
+                (negate, lookups, covered, predicate, values))
+        return clone
 
 
 class VolatileManager(Manager):
@@ -241,21 +1841,91 @@ class VolatileManager(Manager):
         # Most manager methods are delegated to query set.
         return VolatileQuerySet(self.model)
 
-    def _insert(self, objs, fields, **kwargs):
-        # Called from Model.save().
+    def _insert(self, objs, fields, return_id=False, **kwargs):
+        # Called from Model.save(), which expects the new key to be returned.
         VolatileQuerySet(self.model)._store_or_update(objs)
+        if return_id:
+            return objs[-1].pk
+
+    def dump(self, path):
+        """
+        Writes all stored objects to a snapshot file.
+        """
+        handle = self.model.storage
+        storage = handle.pin()
+        try:
+            with open(path, 'wb') as file:
+                write_snapshot(file, self.model, storage.dump_columns())
+        finally:
+            handle.unpin(storage)
+
+    def load(self, path, use_mmap=False):
+        """
+        Replaces stored objects with ones from a snapshot file, without
+        sending any signals. With ``use_mmap`` the file is mapped instead of
+        being read into memory as a whole.
+        """
+        with open(path, 'rb') as file:
+            if use_mmap:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    columns = read_snapshot(buffer, self.model)
+                finally:
+                    buffer.close()
+            else:
+                columns = read_snapshot(file.read(), self.model)
+        # Collections triggered by the many new objects would dominate.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.model.storage.load_columns(columns)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+
+# Custom meta options with their defaults, see VolatileModelBase.
+VOLATILE_OPTIONS = {
+    'volatile_indexes': (),
+    'volatile_sorted_indexes': (),
+    'volatile_storage': VolatileStorage,
+}
 
 
 class VolatileModelBase(ModelBase):
     """
     Creates a class-wide database (dict) for each volatile model subclass.
-    The storage dict is kept sorted at all times.
+    The storage dict is kept sorted at all times; local storages are accessed
+    through a ``VersionedStorage``, which makes them safe to use from threads.
+
+    Fields listed in the ``volatile_indexes`` meta option get hash indexes,
+    and fields in ``volatile_sorted_indexes`` get sorted ones. The storage
+    class may be chosen with ``volatile_storage`` (for example
+    ``ColumnarStorage``). Django does not allow custom meta options, so these
+    are removed from ``Meta`` and stored as attributes of ``_meta``.
     """
     def __new__(cls, name, bases, attrs):
-        abstract = getattr(attrs.get('Meta', None), 'abstract', False)
+        meta = attrs.get('Meta', None)
+        abstract = getattr(meta, 'abstract', False)
+        options = {}
+        for option, default in six.iteritems(VOLATILE_OPTIONS):
+            options[option] = getattr(meta, option, default)
+            if option in getattr(meta, '__dict__', {}):
+                delattr(meta, option)
         new_class = super(VolatileModelBase, cls).__new__(cls, name, bases, attrs)
         if name != 'NewBase' and not abstract:
-            new_class.storage = {}
+            opts = new_class._meta
+            for option, value in six.iteritems(options):
+                setattr(opts, option, value)
+            storage = opts.volatile_storage(
+                new_class,
+                [HashIndex(opts.get_field(field).attname)
+                 for field in opts.volatile_indexes],
+                [SortedIndex(opts.get_field(field).attname)
+                 for field in opts.volatile_sorted_indexes])
+            if isinstance(storage, VolatileStorage):
+                storage = VersionedStorage(storage)
+            new_class.storage = storage
         return new_class
 
 
@@ -278,7 +1948,10 @@ class VolatileModel(six.with_metaclass(VolatileModelBase, Model)):
         return super(VolatileModel, self).save(force_insert, force_update, using, update_fields)
 
     def delete(self, using=None):
-        # Model.delete() defaults to using the router-selected database.
-        if using is None:
-            using = DB_ALIAS
-        return super(VolatileModel, self).delete(using)
+        # Model.delete() would go through the deletion collector and SQL.
+        if using not in (None, DB_ALIAS):
+            raise ValueError("Only operates on the in-memory storage.")
+        assert self._get_pk_val() is not None, (
+            "{} object can't be deleted because its {} attribute is set to "
+            "None.".format(self._meta.object_name, self._meta.pk.attname))
+        VolatileQuerySet(self.__class__)._delete([self])
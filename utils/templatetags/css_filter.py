@@ -2,6 +2,7 @@ import re
 
 from django import template
 from django.template.defaultfilters import stringfilter
+from django.utils.encoding import force_text
 
 ALPHA = '(?:1|(?:0(?:\.\d{1,3})?))'
 PERCENT = '(?:\d{1,3}%)'
@@ -16,6 +17,89 @@ COLOR_NAME_BASE = r'aqua|black|blue|fuchsia|gray|grey|green|lime|maroon|' \
 COLOR = re.compile(r'{}|{}|{}|{}|{}|{}|{}'.format(
     COLOR_HEX_3, COLOR_HEX_6, COLOR_RGB, COLOR_RGBA, COLOR_HSL, COLOR_HSLA,
     COLOR_NAME_BASE))
+COLOR_NAMES = frozenset(COLOR_NAME_BASE.split('|'))
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+LENGTH = re.compile(
+    r'(?:0|-?(?:\d+|\d*\.\d+)(?:px|em|rem|ex|ch|vw|vh|vmin|vmax|cm|mm|in|'
+    r'pt|pc|%))\Z')
+URL = re.compile(r'url\(\s*([\'"]?)[^\'"()\\\s]+\1\s*\)\Z')
+FONT_FAMILY_NAME = r'(?:"[\w\s-]+"|\'[\w\s-]+\'|[a-zA-Z][\w-]*(?:\s+[a-zA-Z][\w-]*)*)'
+FONT_FAMILY = re.compile(r'{0}(?:,\s*{0})*\Z'.format(FONT_FAMILY_NAME))
+Z_INDEX = re.compile(r'(?:auto|-?\d{1,10})\Z')
+
+
+def valid_color(value):
+    # Hex and named colors are recognized without the regex.
+    if value in COLOR_NAMES or (value[:1] == '#' and len(value) in (4, 7) and
+                                HEX_DIGITS.issuperset(value[1:])):
+        return True
+    return COLOR.match(value) is not None
+
+
+VALIDATORS = {
+    'color': valid_color,
+    'length': LENGTH.match,
+    'url': URL.match,
+    'font-family': FONT_FAMILY.match,
+    'z-index': Z_INDEX.match,
+}
+
+# Kinds of values of attributes, other than colors (attributes ending with
+# "color").
+ATTRIBUTE_KINDS = {
+    'background-image': 'url',
+    'border-radius': 'length',
+    'border-width': 'length',
+    'bottom': 'length',
+    'font-family': 'font-family',
+    'font-size': 'length',
+    'height': 'length',
+    'left': 'length',
+    'letter-spacing': 'length',
+    'line-height': 'length',
+    'list-style-image': 'url',
+    'margin': 'length',
+    'max-height': 'length',
+    'max-width': 'length',
+    'min-height': 'length',
+    'min-width': 'length',
+    'padding': 'length',
+    'right': 'length',
+    'top': 'length',
+    'width': 'length',
+    'z-index': 'z-index',
+}
+
+# Validation results by kind and value, cleared when full.
+MEMO_SIZE = 4096
+memo = {}
+
+
+def is_valid(value, kind):
+    key = (kind, value)
+    valid = memo.get(key)
+    if valid is None:
+        try:
+            validator = VALIDATORS[kind]
+        except KeyError:
+            raise NotImplementedError(
+                "Don't know how to escape this kind of value.")
+        valid = bool(validator(value))
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        memo[key] = valid
+    return valid
+
+
+def attribute_kind(attribute):
+    if attribute.endswith('color'):
+        return 'color'
+    try:
+        return ATTRIBUTE_KINDS[attribute]
+    except KeyError:
+        raise NotImplementedError(
+            "Don't know the kind of values of {}.".format(attribute))
 
 
 register = template.Library()
@@ -25,12 +109,23 @@ register = template.Library()
 @stringfilter
 def escapecss(value, kind='color'):
     """
-    Escape a CSS attribute value of some given kind.
+    Escape a CSS attribute value of some given kind: color, length, url,
+    font-family or z-index.
+    """
+    return value if is_valid(value, kind) else ''
+
+
+@register.filter
+def escapecss_dict(values, kind=None):
+    """
+    Escape all values of a dict of CSS attribute values, of some given kind
+    or of kinds depending on their attributes (keys, such as "font-size").
     """
-    if kind == 'color':
-        if COLOR.match(value):
-            return value
+    escaped = {}
+    for attribute, value in values.items():
+        value = force_text(value)
+        if is_valid(value, kind or attribute_kind(attribute)):
+            escaped[attribute] = value
         else:
-            return ''
-    else:
-        raise NotImplemented("Don't know how to escape this kind of value.")
+            escaped[attribute] = ''
+    return escaped
@@ -1,10 +1,133 @@
 from django import template
-from django.utils.formats import number_format
+from django.conf import settings
+from django.test.signals import setting_changed
+from django.utils import numberformat
+from django.utils.formats import get_format
+from django.utils.translation import get_language
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 register = template.Library()
 
 
+class PercentageFormatter(object):
+    """
+    Formats fractions as percentages, as ``number_format`` would, with the
+    separators of a language (None if not localizing) resolved once.
+    """
+    def __init__(self, lang, precision):
+        self.precision = precision
+        self.decimal_sep = get_format('DECIMAL_SEPARATOR', lang)
+        self.thousand_sep = get_format('THOUSAND_SEPARATOR', lang)
+        grouping = get_format('NUMBER_GROUPING', lang)
+        if not (settings.USE_L10N and settings.USE_THOUSAND_SEPARATOR):
+            grouping = 0
+        # Percentages are formatted with "%f", unless numberformat (that
+        # uses str(), giving 12 significant digits on Python 2 and exponents
+        # for small and large numbers) could format them differently.
+        self.limit = 10 ** (11 - precision) if precision >= 0 else 0
+        if not isinstance(grouping, int):
+            # Non-uniform grouping (of newer Django versions).
+            self.limit = 0
+        elif grouping < 0:
+            grouping = 0
+        self.grouping = grouping
+
+    def format(self, value):
+        return self.format_percent(round(float(value) * 100, self.precision))
+
+    def format_percent(self, value):
+        """
+        Formats a percentage already rounded to the precision.
+        """
+        if value and not 1e-4 <= abs(value) < self.limit:
+            return numberformat.format(
+                value, self.decimal_sep, self.precision, self.grouping,
+                self.thousand_sep) + u'%'
+        text = '%.*f' % (self.precision, value)
+        if not self.grouping:
+            return text.replace('.', self.decimal_sep) + u'%'
+        sign = ''
+        if text[0] == '-':
+            sign, text = '-', text[1:]
+        int_part, _, dec_part = text.partition('.')
+        if dec_part:
+            dec_part = self.decimal_sep + dec_part
+        grouping = self.grouping
+        head = len(int_part) % grouping or grouping
+        int_part = self.thousand_sep.join(
+            [int_part[:head]] + [int_part[start:start + grouping] for start in
+                                 range(head, len(int_part), grouping)])
+        return sign + int_part + dec_part + u'%'
+
+    def format_array(self, values):
+        """
+        Formats a NumPy array of fractions (rounded by NumPy, so halves are
+        rounded to even), as a list.
+        """
+        percents = numpy.round(numpy.asarray(values, dtype=float) * 100,
+                               self.precision)
+        texts = numpy.char.mod(u'%%.%df%%%%' % self.precision, percents)
+        if self.decimal_sep != '.':
+            texts = numpy.char.replace(texts, u'.', self.decimal_sep)
+        texts = texts.tolist()
+        # Values that can't be formatted with "%f" or need grouping.
+        magnitudes = numpy.abs(percents)
+        special = (percents != 0) & ((magnitudes < 1e-4) |
+                                     ~(magnitudes < self.limit))
+        if self.grouping and self.limit:
+            special |= magnitudes >= 10 ** self.grouping
+        for index in numpy.flatnonzero(special):
+            texts[index] = self.format_percent(float(percents[index]))
+        return texts
+
+
+formatters = {}
+
+
+def get_formatter(precision):
+    """
+    Formatter for the active language, created once for each precision.
+    """
+    lang = get_language() if settings.USE_L10N else None
+    key = (lang, precision)
+    formatter = formatters.get(key)
+    if formatter is None:
+        formatter = formatters[key] = PercentageFormatter(lang, precision)
+    return formatter
+
+
+def clear_formatters(**kwargs):
+    formatters.clear()
+
+
+setting_changed.connect(clear_formatters)
+
+
+def format_percentages(values, precision=2):
+    """
+    Formats a sequence of fractions as percentages, values that aren't
+    numbers are left as they are. NumPy arrays are formatted in bulk.
+    """
+    formatter = get_formatter(precision)
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        if values.dtype.kind in 'biuf':
+            return formatter.format_array(values)
+        values = values.tolist()
+    formatted = []
+    for value in values:
+        try:
+            value = formatter.format(value)
+        except (TypeError, ValueError):
+            pass
+        formatted.append(value)
+    return formatted
+
+
 @register.filter
 def percentage(value, precision=2):
     """
@@ -12,9 +135,19 @@ def percentage(value, precision=2):
     See: https://code.djangoproject.com/ticket/17662.
     """
     try:
-        precision = int(precision)
-        value = float(value) * 100
+        return get_formatter(int(precision)).format(value)
     except (TypeError, ValueError):
         return value
-    value = round(value, precision)
-    return number_format(value, decimal_pos=precision) + u'%'
+
+
+@register.filter
+def percentages(values, precision=2):
+    """
+    Displays a list (or a NumPy array) of fractions as percentages, for
+    example a column of a table.
+    """
+    try:
+        precision = int(precision)
+    except (TypeError, ValueError):
+        return values
+    return format_percentages(values, precision)
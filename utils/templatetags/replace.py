@@ -1,13 +1,49 @@
+import collections
 import re
+import threading
 
 from django import template
+from django.conf import settings
+from django.utils import six
 
 
 register = template.Library()
 
 
-@register.assignment_tag
-def replace(pattern, replacement, value):
+class PatternCache(object):
+    """
+    Compiled regexes by their patterns, up to a number of them; least recently
+    used ones are evicted first.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def compile(self, pattern):
+        if not isinstance(pattern, six.string_types):
+            # Already compiled (or invalid, left for re to complain about).
+            return pattern
+        with self.lock:
+            regex = self.entries.pop(pattern, None)
+            if regex is not None:
+                self.entries[pattern] = regex
+                return regex
+        regex = re.compile(pattern)
+        with self.lock:
+            self.entries[pattern] = regex
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return regex
+
+
+# Patterns given as variables (the size can be set with
+# REPLACE_PATTERN_CACHE_SIZE).
+patterns = PatternCache(getattr(settings, 'REPLACE_PATTERN_CACHE_SIZE', 1000))
+
+
+@register.tag
+def replace(parser, token):
     """
     Performs a regex substitution on the value, the arguments
     order is the same as for ``re.sub``.
@@ -18,7 +54,45 @@ def replace(pattern, replacement, value):
         ...
         {{ new_string }}
 
+        {% replace "regex" "replacement" string 1 as first_replaced %}
+
+    Literal patterns are compiled with the template, others are kept compiled
+    in a cache of limited size.
+
     Replacement is realized using tags as filters are not meant to support
     multiple arguments; see: https://code.djangoproject.com/ticket/1199.
     """
-    return re.sub(pattern, replacement, value)
+    bits = token.split_contents()
+    if len(bits) not in (6, 7) or bits[-2] != 'as':
+        raise template.TemplateSyntaxError(
+            "'%s' takes a pattern, a replacement, a value and an optional "
+            "count, followed by 'as' and a variable name" % bits[0])
+    args = [parser.compile_filter(bit) for bit in bits[1:-2]]
+    if len(args) == 3:
+        args.append(None)
+    return ReplaceNode(*args, target=bits[-1])
+
+
+class ReplaceNode(template.Node):
+    def __init__(self, pattern, replacement, value, count, target):
+        self.pattern = pattern
+        self.replacement = replacement
+        self.value = value
+        self.count = count
+        self.target = target
+        self.regex = None
+        if isinstance(pattern.var, six.string_types) and not pattern.filters:
+            try:
+                self.regex = re.compile(pattern.var)
+            except re.error as e:
+                raise template.TemplateSyntaxError(
+                    "Invalid pattern %r: %s" % (pattern.var, e))
+
+    def render(self, context):
+        regex = self.regex
+        if regex is None:
+            regex = patterns.compile(self.pattern.resolve(context))
+        count = 0 if self.count is None else int(self.count.resolve(context))
+        context[self.target] = regex.sub(self.replacement.resolve(context),
+                                         self.value.resolve(context), count)
+        return ''
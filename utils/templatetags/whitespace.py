@@ -1,13 +1,20 @@
 import re
 
 from django import template
+from django.template.base import TextNode
 from django.template.defaultfilters import stringfilter
 
+from utils import instrumentation
+
 
 INPUT_START_WS = re.compile(r'\A\s+')
 LINE_START_WS = re.compile(r'^(?!\n)\s*', re.MULTILINE)
 LINE_START = re.compile(r'^(?!\n)', re.MULTILINE)
 BLANK_LINES = re.compile(r'\n\s*\n', re.MULTILINE)
+LEADING_WS = re.compile(r'\s*')
+TRAILING_WS = re.compile(r'\s*\Z')
+
+WHITESPACE = ' \t\n\r\f\v'
 
 
 register = template.Library()
@@ -32,6 +39,7 @@ def indent_tag(parser, token):
         {% indent =2 %} fixes indentation (for each line removes all whitespace
                         from its start, and then prepends 2 tabs);
         {% indent +2 %} adds 2 tabs to each line;
+        {% indent -1 %} removes up to 1 tab from the start of each line;
         {% indent =2s %} does not remove starting whitespace (useful if you
                          don't want to indent your {% indent %} tags).
     """
@@ -57,26 +65,349 @@ def indent_tag(parser, token):
     return IndentNode(ns, m, i, s)
 
 
+class Indentation(object):
+    """
+    Change of line starts: all leading whitespace (if ``reset``) or up to
+    ``remove`` tabs are removed, and then ``add`` tabs are prepended. Lines
+    of up to ``clear`` tabs (``remove`` by default) are emptied first, and
+    not indented.
+    """
+    _patterns = {}
+
+    def __init__(self, reset, remove, add, clear=None):
+        self.reset = reset
+        self.remove = remove
+        self.add = add
+        self.clear = remove if clear is None else clear
+        self.tabs = '\t' * add
+        self.key = (reset, remove, add, self.clear)
+
+    def within(self, outer):
+        """
+        Indentation equal to this one followed by ``outer``.
+        """
+        if outer.reset:
+            if self.reset:
+                clear = self.clear
+            else:
+                clear = max(self.clear, self.remove + outer.clear - self.add)
+            return Indentation(True, 0, outer.add, clear)
+        if self.reset:
+            return Indentation(True, 0,
+                               max(self.add - outer.remove, 0) + outer.add,
+                               self.clear)
+        if outer.remove <= self.add:
+            return Indentation(False, self.remove,
+                               self.add - outer.remove + outer.add)
+        return Indentation(False, self.remove + outer.remove - self.add,
+                           outer.add)
+
+    def pattern(self, at_end=True):
+        """
+        Matches line starts (except for empty lines and, unless ``at_end``,
+        the end of the text) with the whitespace to remove.
+        """
+        key = (self.reset, self.remove, at_end)
+        pattern = self._patterns.get(key)
+        if pattern is None:
+            if self.reset:
+                remove = r'\s*'
+            elif self.remove:
+                remove = r'\t{0,%d}' % self.remove
+            else:
+                remove = ''
+            pattern = self._patterns[key] = re.compile(
+                r'^(?!\n%s)%s' % ('' if at_end else r'|\Z', remove),
+                re.MULTILINE)
+        return pattern
+
+    def cleared(self):
+        """
+        Matches lines to empty (without their new lines).
+        """
+        key = self.clear
+        pattern = self._patterns.get(key)
+        if pattern is None:
+            pattern = self._patterns[key] = re.compile(
+                r'^\t{1,%d}(?=\n)' % self.clear, re.MULTILINE)
+        return pattern
+
+    def start(self, text):
+        """
+        Position after the whitespace to remove at the line start beginning
+        the text and the tabs to put there, or None if the line is empty.
+        """
+        if self.clear:
+            match = self.cleared().match(text)
+            if match is not None:
+                return match.end(), ''
+        match = self.pattern().match(text)
+        if match is None:
+            return None
+        return match.end(), self.tabs
+
+    def apply_first(self, text):
+        """
+        Indents the line starting the text (if it's not empty).
+        """
+        start = self.start(text)
+        if start is None:
+            return text
+        return start[1] + text[start[0]:]
+
+    def empty(self, text, start):
+        """
+        Empties lines of up to ``clear`` tabs starting after ``start``.
+        """
+        if not self.clear or text.find('\t\n', start) == -1:
+            return text
+        return text[:start] + self.cleared().sub('', text[start:])
+
+    def pending(self, text, start):
+        """
+        Position of the line start (after a new line following ``start``)
+        whose whitespace to remove may continue after the text, or None.
+        """
+        if self.reset:
+            end = max(len(text.rstrip(WHITESPACE)), start + 1)
+            newline = text.find('\n', end - 1)
+            while newline != -1:
+                line = newline + 1
+                if line == len(text) or text[line] != '\n':
+                    return line
+                newline = text.find('\n', line)
+            return None
+        line = text.rfind('\n') + 1
+        if line <= start or len(text) - line > self.remove:
+            return None
+        if text.count('\t', line) != len(text) - line:
+            return None
+        return line
+
+
+def indent_static(text, indentation):
+    """
+    Indents lines of static text after its first line with content. Returns
+    the text before them (or all of the text, if there are none), the indented
+    lines and the last line start, if the whitespace to remove there may
+    continue after the text (or None).
+    """
+    newline = text.find('\n', LEADING_WS.match(text).end())
+    if newline == -1:
+        return text, None, None
+    text = indentation.empty(text, newline)
+    line = indentation.pending(text, newline)
+    last = None
+    if line is not None:
+        text, last = text[:line], text[line:]
+    return (text[:newline],
+            indentation.pattern(False).sub(indentation.tabs, text[newline:]),
+            last)
+
+
+def strip_start(text):
+    match = INPUT_START_WS.match(text)
+    return text if match is None else text[match.end():]
+
+
+def indent_text(text, first, rest):
+    """
+    Indents the text, its start with ``first`` (None if it doesn't start a
+    line) and other line starts with ``rest``. Returns the indented text and
+    its unprocessed end that starts a line, if the whitespace to remove there
+    may continue after the text (or None), with the indentation for it.
+    """
+    head = ''
+    if first is not None:
+        start = first.start(text)
+        if start is not None:
+            if start[0] == len(text):
+                return '', text, first
+            head, text = start[1], text[start[0]:]
+    newline = text.find('\n')
+    if newline == -1:
+        return head + text, None, None
+    text = rest.empty(text, newline)
+    line = rest.pending(text, newline)
+    tail = None
+    if line is not None:
+        text, tail = text[:line], text[line:]
+    text = text[:newline] + rest.pattern(False).sub(rest.tabs, text[newline:])
+    return head + text, tail, rest
+
+
 class IndentNode(template.Node):
+    """
+    Blocks nested directly in other ones get the indentation of the enclosing
+    blocks and indent their lines once, with all indentations combined,
+    leaving their first and last line starts to the enclosing block (as these
+    may continue lines of the enclosing block). Output of other nodes,
+    including blocks nested in other tags, is indented as any text.
+    """
+    child_nodelists = ('nodes',)
+
     def __init__(self, nodes, mode, indent, starting):
         self.nodes = nodes
         self.mode = mode
         self.indent = indent
         self.starting = starting
+        if mode == '=':
+            self.indentation = Indentation(True, 0, indent)
+        elif mode == '+':
+            self.indentation = Indentation(False, 0, indent)
+        else:
+            self.indentation = Indentation(False, indent, 0)
+        # Blocks of static text are indented once for each indentation of the
+        # enclosing blocks, otherwise static text and nested blocks are kept
+        # apart from runs of other nodes. Both are prepared when first
+        # rendered, as loaders may still change the text after parsing.
+        self.static = all(isinstance(node, TextNode) for node in nodes)
+        self.outputs = {}
+        self.parts = None
+
+    def split(self):
+        parts = []
+        run = None
+        for node in self.nodes:
+            if type(node) is TextNode:
+                parts.append(IndentedText(node.s))
+                run = None
+            elif isinstance(node, IndentNode):
+                parts.append(node)
+                run = None
+            else:
+                if run is None:
+                    run = type(self.nodes)()
+                    parts.append(run)
+                run.append(node)
+        return parts
 
     def render(self, context):
-        r = self.nodes.render(context)
-        i = r'\t' * int(self.indent)
-        if self.mode == '=':
-            r = LINE_START_WS.sub(i, r)
-        elif self.mode == '+':
-            r = LINE_START.sub(i, r)
-        else:
-            raise NotImplementedError(
-                "Only fixed and plus are supported at the moment.")
+        return self.render_within(context, None)[0]
+
+    def render_within(self, context, outer):
+        """
+        Renders the block, given indentation of the enclosing blocks (None if
+        there are none), see ``indent_content()``.
+        """
+        if self.static:
+            started = instrumentation.start()
+            key = None if outer is None else outer.key
+            output = self.outputs.get(key)
+            if output is None:
+                text = ''.join(node.s for node in self.nodes)
+                output = self.outputs[key] = self.indent_content(
+                    [(text, None, None)], outer)
+            if started is not None:
+                size = len(output[0]) + len(output[1] or '')
+                instrumentation.record('indent', started, size, size, 0)
+            return output
+        own = self.indentation
+        segments = self.render_segments(
+            context, own if outer is None else own.within(outer))
+        started = instrumentation.start()
+        output = self.indent_content(segments, outer)
+        if started is not None:
+            size = sum(len(text) + len(body or '') + len(last or '')
+                       for text, body, last in segments)
+            instrumentation.record('indent', started, size,
+                                   len(output[0]) + len(output[1] or ''),
+                                   2 if self.starting else 1)
+        return output
+
+    def render_segments(self, context, indentation):
+        """
+        Renders the content as a list of text, each followed by lines
+        already indented (of static text or a nested block) and their last
+        line start, that may still have to be indented (or None).
+        """
+        parts = self.parts
+        if parts is None:
+            parts = self.parts = self.split()
+        segments = []
+        texts = []
+        for part in parts:
+            if isinstance(part, IndentNode):
+                body, last = part.render_within(context, indentation)
+            elif isinstance(part, IndentedText):
+                text, body, last = part.indent(indentation)
+                texts.append(text)
+                if body is None:
+                    continue
+            else:
+                texts.append(part.render(context))
+                continue
+            segments.append((''.join(texts), body, last))
+            texts = []
+        segments.append((''.join(texts), None, None))
+        return segments
+
+    def indent_content(self, segments, outer):
+        """
+        Indents the rendered content, given indentation of the enclosing
+        blocks (None if there are none). Returns the indented content and its
+        last line start, left to the enclosing block (or None).
+        """
+        own = self.indentation
+        indentation = own if outer is None else own.within(outer)
+        indented = []
+        # Start of a line with whitespace that may continue in next parts.
+        carry, carry_indentation, initial = '', own, True
+        for text, body, last in segments:
+            first = None
+            if carry is not None:
+                text, first = carry + text, carry_indentation
+            text, carry, carry_indentation = indent_text(text, first,
+                                                         indentation)
+            if text:
+                indented.append(text)
+                initial = False
+            if body is None:
+                break
+            if carry is not None:
+                body = carry + body
+                start = carry_indentation.start(body)
+                if start is not None and start[0] == len(body):
+                    carry = body + (last or '')
+                    continue
+                if start is not None:
+                    body = start[1] + body[start[0]:]
+                carry = None
+            if body:
+                indented.append(body)
+                initial = False
+            if last is not None:
+                carry, carry_indentation, initial = last, indentation, False
+        last = None
+        if carry is not None:
+            # The last line start is also one of the enclosing block.
+            if outer is None or initial:
+                indented.append(own.apply_first(carry))
+            else:
+                last = own.apply_first(carry)
+        r = ''.join(indented)
         if self.starting:
-            r = INPUT_START_WS.sub('', r)
-        return r
+            r = strip_start(r)
+            if not r and last is not None:
+                last = strip_start(last) or None
+        return r, last
+
+
+class IndentedText(object):
+    """
+    Static text in an indent block, with lines after the first one indented
+    once for each indentation of the block.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.outputs = {}
+
+    def indent(self, indentation):
+        output = self.outputs.get(indentation.key)
+        if output is None:
+            output = self.outputs[indentation.key] = indent_static(
+                self.text, indentation)
+        return output
 
 
 @register.tag(name='blankless')
@@ -108,9 +439,68 @@ def blankless(parser, token):
 
 
 class BlankLessNode(template.Node):
+    """
+    Blank lines are removed from static text once, when the block is first
+    rendered (after loaders are done with the text), leaving only whitespace
+    at its ends (which may continue in output of other nodes) and the output
+    of other nodes to process on each rendering. Blocks of static text are
+    rendered once.
+    """
+    child_nodelists = ('nodes',)
+
     def __init__(self, nodes):
         self.nodes = nodes
+        self.static = all(isinstance(node, TextNode) for node in nodes)
+        self.output = None
+        self.parts = None
+
+    def split(self):
+        """
+        Runs of nodes to render and process, each followed by processed
+        static text (or None).
+        """
+        parts = []
+        run = type(self.nodes)()
+        for node in self.nodes:
+            if type(node) is TextNode:
+                start = LEADING_WS.match(node.s).end()
+                end = TRAILING_WS.search(node.s, start).start()
+                if start < end:
+                    run.append(TextNode(node.s[:start]))
+                    parts.append(
+                        (run, BLANK_LINES.sub('\n', node.s[start:end])))
+                    run = type(self.nodes)()
+                    node = TextNode(node.s[end:])
+            run.append(node)
+        parts.append((run, None))
+        return parts
 
     def render(self, context):
-        r = self.nodes.render(context)
-        return BLANK_LINES.sub('\n', r).strip()
+        if self.static:
+            output = self.output
+            if output is None:
+                output = self.output = BLANK_LINES.sub(
+                    '\n', ''.join(node.s for node in self.nodes)).strip()
+            started = instrumentation.start()
+            if started is not None:
+                instrumentation.record('blankless', started, len(output),
+                                       len(output), 0)
+            return output
+        parts = self.parts
+        if parts is None:
+            parts = self.parts = self.split()
+        rendered = [(run.render(context), static)
+                    for run, static in parts]
+        started = instrumentation.start()
+        pieces = []
+        for text, static in rendered:
+            pieces.append(BLANK_LINES.sub('\n', text))
+            if static is not None:
+                pieces.append(static)
+        r = ''.join(pieces).strip()
+        if started is not None:
+            size = sum(len(text) + len(static or '')
+                       for text, static in rendered)
+            instrumentation.record('blankless', started, size, len(r),
+                                   len(parts))
+        return r
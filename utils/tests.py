@@ -0,0 +1,152 @@
+import hashlib
+import re
+import zlib
+
+from django.core.signals import request_finished
+from django.db import models
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template import Context
+from django.template.loader import get_template_from_string
+from django.test import RequestFactory, SimpleTestCase
+from django.test.utils import override_settings
+
+from utils import instrumentation
+from utils.loaders import WhitespaceLoader
+from utils.middleware import (HTMLPostProcessMiddleware,
+                              MinifyCompressMiddleware,
+                              NoStartingTrailingBlankLinesMiddleware,
+                              NoWhitespaceLinesMiddleware, TidyMiddleware,
+                              tidy_stats)
+from utils.models import ColumnarStorage, VolatileModel
+
+
+class Point(VolatileModel):
+    x = models.IntegerField()
+    name = models.CharField(max_length=10, null=True)
+
+    class Meta:
+        volatile_indexes = ('x',)
+        volatile_storage = ColumnarStorage
+
+
+class ColumnarCopyOnWriteTest(SimpleTestCase):
+    def setUp(self):
+        Point.objects.all().delete()
+
+    def test_large_write(self):
+        # Writes of more than in_place_size objects go to a copy.
+        Point.objects.bulk_create([Point(x=i) for i in range(150)])
+        Point.objects.bulk_create([Point(x=i, name='b') for i in range(150)])
+        points = list(Point.objects.all())
+        self.assertEqual(len(points), 300)
+        self.assertEqual([point.name for point in points[149:151]],
+                         [None, 'b'])
+        self.assertEqual(Point.objects.filter(x=3).count(), 2)
+
+    def test_write_while_pinned(self):
+        Point.objects.bulk_create([Point(x=i) for i in range(10)])
+        points = Point.objects.iterator()
+        next(points)
+        Point.objects.filter(x=5).delete()
+        Point.objects.bulk_create([Point(x=10)])
+        self.assertEqual(len(list(points)), 9)
+        self.assertEqual([point.x for point in Point.objects.all()],
+                         [0, 1, 2, 3, 4, 6, 7, 8, 9, 10])
+
+
+class QuerySetTest(SimpleTestCase):
+    def setUp(self):
+        Point.objects.all().delete()
+
+    def test_exists_with_none_value(self):
+        Point.objects.bulk_create([Point(x=1), Point(x=2, name='b')])
+        names = Point.objects.order_by('x').values_list('name', flat=True)
+        self.assertTrue(names.exists())
+        self.assertFalse(Point.objects.filter(x=3).exists())
+
+
+class WhitespaceLoaderTest(SimpleTestCase):
+    def render(self, source, **context):
+        template = get_template_from_string(source)
+        WhitespaceLoader([]).strip(template)
+        return template.render(Context(context))
+
+    def test_blank_lines(self):
+        self.assertEqual(self.render('\n  \n<p>\n \n{{ v }}</p>\n\n \n', v=1),
+                         '\n<p>\n1</p>\n')
+
+    def test_single_new_lines_kept(self):
+        self.assertEqual(self.render('Hello\n'), 'Hello\n')
+        self.assertEqual(self.render('\nworld'), '\nworld')
+
+    def test_text_in_whitespace_tags(self):
+        source = ('{% load whitespace %}{% indent +1 %}a\n  \n{{ v }}\n'
+                  '{% indent +1 %}b\n \nc{% endindent %}{% endindent %}')
+        self.assertEqual(self.render(source, v=1), 'a\n\t1\n\tb\n\t\tc')
+
+
+class StreamingFilterTest(SimpleTestCase):
+    def test_content_length_removed(self):
+        for middleware in (NoStartingTrailingBlankLinesMiddleware(),
+                           NoWhitespaceLinesMiddleware(),
+                           HTMLPostProcessMiddleware()):
+            response = StreamingHttpResponse(['\n\n<p>\n', '  \n</p>\n\n'])
+            response['Content-Length'] = '16'
+            response = middleware.process_response(None, response)
+            self.assertFalse(response.has_header('Content-Length'))
+            self.assertNotEqual(len(b''.join(response.streaming_content)), 16)
+
+
+class TidyStatsTest(SimpleTestCase):
+    def test_cache_hit(self):
+        middleware = TidyMiddleware()
+        content = b'<p>a</p>'
+        middleware.cache.put(hashlib.sha1(content).digest(), b'<p>b</p>')
+        before = tidy_stats()
+        response = middleware.process_response(RequestFactory().get('/'),
+                                               HttpResponse(content))
+        self.assertEqual(response.content, b'<p>b</p>')
+        after = tidy_stats()
+        self.assertEqual(after['hits'], before['hits'] + 1)
+        self.assertEqual(after['misses'], before['misses'])
+        self.assertGreaterEqual(after['hit_time'], before['hit_time'])
+
+
+@override_settings(DEBUG=True)
+class ServerTimingTest(SimpleTestCase):
+    def test_pending_entries(self):
+        instrumentation.reset_pending()
+        for i in range(instrumentation.MAX_PENDING + 10):
+            instrumentation.record('tag', instrumentation.start(), 1, 1, 0)
+        self.assertEqual(len(instrumentation.get_pending()),
+                         instrumentation.MAX_PENDING)
+        request_finished.send(sender=None)
+        instrumentation.record('tag', instrumentation.start(), 2, 1, 0)
+        response = HttpResponse()
+        instrumentation.record('middleware', instrumentation.start(), 1, 1, 1,
+                               response)
+        self.assertEqual(re.findall(r'(?:^|, )([\w-]+);dur=',
+                                    response['Server-Timing']),
+                         ['tag', 'middleware'])
+        self.assertEqual(instrumentation.get_pending(), ())
+
+
+class CompressionCacheTest(SimpleTestCase):
+    def respond(self, middleware, content, **headers):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='deflate',
+                                       **headers)
+        response = HttpResponse(content)
+        response['ETag'] = '"a"'
+        response['Vary'] = 'Cookie'
+        response = middleware.process_response(request, response)
+        return zlib.decompress(response.content)
+
+    def test_vary(self):
+        middleware = MinifyCompressMiddleware()
+        first, second = b'<p>first</p>' * 20, b'<p>second</p>' * 20
+        self.assertEqual(self.respond(middleware, first, HTTP_COOKIE='a=1'),
+                         first)
+        self.assertEqual(self.respond(middleware, second, HTTP_COOKIE='a=2'),
+                         second)
+        self.assertEqual(self.respond(middleware, second, HTTP_COOKIE='a=1'),
+                         first)